@@ -0,0 +1,216 @@
+"""
+Phase-level benchmark of the week1 assembler
+
+Every case runs in a fresh process, so its peak RSS is its own. Phases:
+read (reads into memory), build (graph construction, compaction and
+simplification), traverse (longest path search and deletion), concat (contig
+strings) and write (FASTA output).
+
+Usage:
+    python week1/code/benchmark.py [--data DATASET ...] [--synthetic SIZE ...] [-o results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import Pipe, Process
+
+import numpy as np
+
+from dbg import DBG
+from utils import calculate_n50, read_data
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+DATASETS = ('data1', 'data2', 'data3', 'data4')
+
+
+def synthetic_reads(genome_size, coverage=30, read_len=100, error_rate=0.01, seed=0):
+    """
+    Paired-end-like short reads of a random genome
+
+    Args:
+        genome_size: Genome length in bases
+        coverage: Mean coverage over both read sets
+        read_len: Read length
+        error_rate: Probability of a substitution per base
+        seed: Random seed
+
+    Returns:
+        [short1, short2]: forward reads and reverse-complement reads
+    """
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    genome = rng.integers(0, 4, genome_size, dtype=np.uint8)
+    n_reads = max(genome_size * coverage // (2 * read_len), 1)
+    data_list = []
+    for strand in range(2):
+        starts = rng.integers(0, max(genome_size - read_len, 1), n_reads)
+        reads = genome[starts[:, None] + np.arange(min(read_len, genome_size))]
+        errors = rng.random(reads.shape) < error_rate
+        reads[errors] = rng.integers(0, 4, np.count_nonzero(errors), dtype=np.uint8)
+        if strand:
+            reads = 3 - reads[:, ::-1]
+        data_list.append([read.decode('ascii') for read in bases[reads].view(f'S{reads.shape[1]}').ravel()])
+    return data_list
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def run_case(name, source, k=25, n_contigs=20, **options):
+    """
+    Time every phase of one assembly
+
+    Args:
+        name: Case name in the results
+        source: Dataset directory or .zip archive, or a genome size for synthetic reads
+        k: k-mer length
+        n_contigs: Number of contigs extracted
+        options: Further DBG arguments
+
+    Returns:
+        Dictionary of phase timings, peak RSS after every phase, graph size and throughput
+    """
+    phases = {}
+    start = time.perf_counter()
+
+    def finish(phase, seconds=None):
+        nonlocal start
+        now = time.perf_counter()
+        phases[phase] = {'seconds': now - start if seconds is None else seconds,
+                         'peak_rss_mb': _peak_rss_mb()}
+        start = now
+
+    if isinstance(source, int):
+        data_list = synthetic_reads(source)
+    else:
+        data_list = [list(reads) for reads in read_data(source)]
+    finish('read')
+
+    dbg = DBG(k=k, data_list=data_list, packed=k <= 32, **options)
+    finish('build')
+
+    contigs = []
+    traverse = concat = 0.0
+    for _ in range(n_contigs):
+        t0 = time.perf_counter()
+        path = dbg._get_longest_path()
+        t1 = time.perf_counter()
+        contig = dbg._concat_path(path)
+        t2 = time.perf_counter()
+        dbg._delete_path(path)
+        traverse += (t1 - t0) + (time.perf_counter() - t2)
+        concat += t2 - t1
+        if contig is None:
+            break
+        contigs.append(contig)
+    finish('traverse', traverse)
+    finish('concat', concat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'contig.fasta'), 'w') as f:
+            for i, c in enumerate(contigs):
+                print(f">contig_{i}\n{c}", file=f)
+    finish('write')
+
+    build_seconds = phases['build']['seconds']
+    return {
+        'name': name,
+        'k': k,
+        'phases': phases,
+        'total_seconds': sum(phase['seconds'] for phase in phases.values()),
+        'peak_rss_mb': _peak_rss_mb(),
+        'nodes': dbg.kmer_count,
+        'edges': dbg.arc_count,
+        'nodes_per_second': dbg.kmer_count / build_seconds,
+        'edges_per_second': dbg.arc_count / build_seconds,
+        'contigs': len(contigs),
+        'n50': calculate_n50(contigs),
+    }
+
+
+def _send_case(conn, name, source, kwargs):
+    # result of run_case, or the exception it raised, back to the parent
+    try:
+        result = run_case(name, source, **kwargs)
+    except Exception as error:
+        result = error
+    conn.send(result)
+    conn.close()
+
+
+def run_benchmarks(cases, **kwargs):
+    """
+    Run every (name, source) case in its own process
+
+    Cases run in plain (non-daemonic) processes, so a case may start worker
+    processes of its own, e.g. with workers > 1.
+
+    Returns:
+        Results in JSON-serializable form, with the platform they were taken on
+    """
+    results = []
+    for name, source in cases:
+        # a new process per case keeps peak RSS from leaking between cases
+        receiver, sender = Pipe(duplex=False)
+        process = Process(target=_send_case, args=(sender, name, source, kwargs))
+        process.start()
+        sender.close()
+        try:
+            result = receiver.recv()
+        except EOFError:
+            # the case died without sending, e.g. killed for running out of memory
+            process.join()
+            raise RuntimeError(f"Benchmark case {name} exited with code {process.exitcode}")
+        process.join()
+        if isinstance(result, Exception):
+            raise result
+        results.append(result)
+        print(f"{name}: {results[-1]['total_seconds']:.2f} s", file=sys.stderr)
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'cases': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--data', nargs='*', default=None,
+                        help="Datasets (directory or .zip); default: data1-data4 when present")
+    parser.add_argument('--synthetic', nargs='*', type=int, default=[],
+                        help="Genome sizes of synthetic read sets")
+    parser.add_argument('-k', type=int, default=25)
+    parser.add_argument('--contigs', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=1, help="Processes counting k-mers")
+    parser.add_argument('--no-simplify', action='store_true')
+    parser.add_argument('-o', '--output', help="JSON file; default: stdout")
+    args = parser.parse_args(argv)
+
+    if args.data is None:
+        args.data = [path for path in (os.path.join(DATA_DIR, name + '.zip') for name in DATASETS)
+                     if os.path.exists(path)]
+    cases = [(os.path.basename(path).rsplit('.zip', 1)[0], path) for path in args.data]
+    cases += [(f"synthetic_{size}", size) for size in args.synthetic]
+    results = run_benchmarks(cases, k=args.k, n_contigs=args.contigs,
+                             simplify=not args.no_simplify, workers=args.workers)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import numpy as np
+
+from kmer import encode_bases, read_kmers, rolling_codes
+from utils import BATCH_READS, iter_batches, map_rounds, shared_object, worker_pool
+
+
+class ContigIndex:
+    """
+    Maps the k-mers of a set of contigs, on both strands, to their contigs and positions
+
+    A k-mer can occur in several contigs; assemblies from both strands of the
+    graph typically hold every contig also as its reverse complement.
+
+    Args:
+        contigs: Contig sequences
+        k: k-mer length (at most 32)
+    """
+    def __init__(self, contigs, k):
+        if k > 32:
+            raise ValueError("The contig index requires k <= 32")
+        self.k = k
+        self.lengths = np.array([len(c) for c in contigs], dtype=np.int64)
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        windows = [rolling_codes(encode_bases(c), k) for c in contigs]
+        n_windows = [len(fwd) for fwd, _ in windows]
+        # every window once per strand: forward codes, then reverse-complement codes
+        codes = np.concatenate([np.zeros(0, dtype=np.uint64)] + [code for pair in windows for code in pair])
+        contig = np.repeat(np.arange(len(contigs)), 2 * np.array(n_windows, dtype=np.int64))
+        position = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.tile(np.arange(n), 2) for n in n_windows])
+        strand = np.concatenate([np.zeros(0, dtype=np.int8)] + [np.repeat(np.int8([0, 1]), n) for n in n_windows])
+
+        order = np.argsort(codes, kind='stable')
+        self._keys = codes[order]
+        self._contig, self._position, self._strand = contig[order], position[order], strand[order]
+
+    def place(self, reads):
+        """
+        Contig intervals covered by the reads
+
+        A read is placed on every contig it shares an indexed k-mer with, by the
+        first such k-mer and on the strand it matches; intervals are clipped to
+        the contig.
+
+        Returns:
+            (contig, start, end) arrays, one entry per placement
+        """
+        codes, read, position = read_kmers(reads, self.k)
+        # every occurrence of every read k-mer, in read order
+        lo = np.searchsorted(self._keys, codes, side='left')
+        n_hits = np.searchsorted(self._keys, codes, side='right') - lo
+        read, offset = np.repeat(read, n_hits), np.repeat(position, n_hits)
+        hit = np.arange(len(read)) + np.repeat(lo - (np.cumsum(n_hits) - n_hits), n_hits)
+        # so the first hit of a read on a contig comes first
+        _, first = np.unique(read * len(self.lengths) + self._contig[hit], return_index=True)
+        hit, read, offset = hit[first], read[first], offset[first]
+        lengths = np.fromiter(map(len, reads), dtype=np.int64, count=len(reads))[read]
+        contig, contig_pos = self._contig[hit], self._position[hit]
+        # forward: read base 0 sits at contig_pos - offset; reverse complement:
+        # read base 0 sits at contig_pos + k - 1 + offset and the read runs backwards
+        start = np.where(self._strand[hit] == 0, contig_pos - offset,
+                         contig_pos + self.k + offset - lengths)
+        end = start + lengths
+        contig_len = self.lengths[contig]
+        return contig, np.clip(start, 0, contig_len), np.clip(end, 0, contig_len)
+
+    def intervals(self, reads):
+        """
+        Intervals covered by the reads, as (start, end) positions in the
+        concatenation of all contigs
+        """
+        contig, start, end = self.place(reads)
+        return self.offsets[contig] + start, self.offsets[contig] + end
+
+
+def _intervals(reads):
+    # the contig index is shared with the coverage workers
+    return shared_object().intervals(reads)
+
+
+def contig_coverage(contigs, data_list, k, workers=1, batch_reads=BATCH_READS):
+    """
+    Per-base read depth and mean coverage of every contig
+
+    Reads are streamed once in batches; with several workers the batches are
+    placed in worker processes. Only the read intervals come back from a batch,
+    and they are added into one difference array over all contigs.
+
+    Args:
+        contigs: Contig sequences
+        data_list: Collections of reads, as passed to DBG
+        k: Length of the k-mers reads are placed by (at most 32)
+        workers: Number of worker processes
+
+    Returns:
+        (mean_coverage, depths): a float array with one value per contig and a list
+        of int64 depth arrays, one per contig base
+    """
+    index = ContigIndex(contigs, k)
+    changes = np.zeros(int(index.lengths.sum()) + 1, dtype=np.int64)
+    batches = (reads for data in data_list for reads in iter_batches(data, batch_reads))
+    if workers > 1:
+        with worker_pool(workers, index) as pool:
+            for start, end in map_rounds(pool, _intervals, ((reads,) for reads in batches), workers):
+                np.add.at(changes, start, 1)
+                np.add.at(changes, end, -1)
+    else:
+        for reads in batches:
+            start, end = index.intervals(reads)
+            np.add.at(changes, start, 1)
+            np.add.at(changes, end, -1)
+
+    depth = np.cumsum(changes[:-1])
+    depths = np.split(depth, index.offsets[1:]) if len(contigs) else []
+    mean_coverage = np.array([d.mean() if len(d) else 0.0 for d in depths])
+    return mean_coverage, depths
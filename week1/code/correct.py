@@ -0,0 +1,163 @@
+import numpy as np
+
+from kmer import BASES, find_sorted, read_kmers
+from kmer_count import BLOOM_BITS, solid_kmers
+from utils import BATCH_READS, iter_batches, map_rounds, shared_object, worker_pool
+
+MAX_ROUNDS = 3
+
+
+def _candidates(reads, k, read, position, weak):
+    # (read, base, first, last) of every base to try: the base an isolated run of
+    # weak k-mers points at, checked against all k-mers covering it, and the base
+    # entering (leaving) a longer run at its start (end), checked against the
+    # first (last) k-mer of the run only
+    new_run = weak & np.concatenate([[True], ~weak[:-1] | (read[1:] != read[:-1])])
+    starts = np.flatnonzero(new_run)
+    ends = np.flatnonzero(weak & np.concatenate([~weak[1:] | (read[1:] != read[:-1]), [True]]))
+    lengths = ends - starts + 1
+    n_kmers = np.fromiter((max(len(r) - k + 1, 0) for r in reads), dtype=np.int64, count=len(reads))
+    run_read, first, last = read[starts], position[starts], position[ends]
+    at_start, at_end = first == 0, last == n_kmers[run_read] - 1
+
+    isolated = (lengths == k) | ((at_start ^ at_end) & (lengths < k))
+    base = np.where(at_start & (lengths < k), last, first + k - 1)
+    cover_first = np.maximum(base - k + 1, 0)
+    cover_last = np.minimum(base, n_kmers[run_read] - 1)
+    long_start = (lengths > k) & ~at_start
+    long_end = (lengths > k) & ~at_end
+    return (np.concatenate([run_read[isolated], run_read[long_start], run_read[long_end]]),
+            np.concatenate([base[isolated], first[long_start] + k - 1, last[long_end]]),
+            np.concatenate([cover_first[isolated], first[long_start], last[long_end]]),
+            np.concatenate([cover_last[isolated], first[long_start], last[long_end]]))
+
+
+def _correct_round(reads, k, solid):
+    # one substitution per candidate base; returns the indices of changed reads
+    # and the number of bases changed
+    codes, read, position = read_kmers(reads, k)
+    weak = ~find_sorted(solid, codes)[1]
+    if not weak.any():
+        return [], 0
+    cand_read, base, lo, hi = _candidates(reads, k, read, position, weak)
+
+    # the checked k-mers of every candidate, with the base replaced by each alternative
+    n_kmers = np.fromiter((max(len(r) - k + 1, 0) for r in reads), dtype=np.int64, count=len(reads))
+    read_starts = np.cumsum(n_kmers) - n_kmers
+    n_check = hi - lo + 1
+    candidate = np.repeat(np.arange(len(base)), n_check)
+    kmer_pos = np.arange(int(n_check.sum())) - np.repeat(np.cumsum(n_check) - n_check, n_check) \
+        + np.repeat(lo, n_check)
+    checked = codes[read_starts[cand_read][candidate] + kmer_pos]
+    shift = (2 * (k - 1 - (base[candidate] - kmer_pos))).astype(np.uint64)
+    fits = np.zeros((len(base), 3), dtype=bool)
+    for delta in range(1, 4):
+        # old base ^ delta runs over the three other bases
+        solid_after = find_sorted(solid, checked ^ (np.uint64(delta) << shift))[1]
+        fits[:, delta - 1] = np.bincount(candidate[~solid_after], minlength=len(base)) == 0
+    fixed = np.flatnonzero(fits.sum(axis=1) == 1)
+
+    changed = set()
+    first_check = np.cumsum(n_check) - n_check
+    old_base = (checked >> shift)[first_check[fixed]] & np.uint64(3)
+    new_base = old_base ^ (np.argmax(fits[fixed], axis=1) + 1).astype(np.uint64)
+    for i, p, b in zip(cand_read[fixed].tolist(), base[fixed].tolist(), new_base.tolist()):
+        reads[i] = reads[i][:p] + BASES[b] + reads[i][p + 1:]
+        changed.add(i)
+    return sorted(changed), len(fixed)
+
+
+def correct_batch(reads, k, solid, rounds=MAX_ROUNDS):
+    """
+    Fix isolated substitution errors in a batch of reads
+
+    A substitution at base p of a read makes the k-mers starting at p - k + 1 .. p
+    weak (not solid). A run of weak k-mers of that shape (exactly k long, or cut
+    short by a read end) points at one base, which is replaced when exactly one
+    of the three alternatives makes all k-mers covering it solid. Longer runs,
+    from errors closer than k bases, get the base at each of their ends fixed the
+    same way against the first (last) k-mer of the run, and rounds repeat on the
+    reads that changed. Reads without such runs are returned unchanged.
+
+    Args:
+        reads: List of read sequences
+        k: k-mer length (at most 32)
+        solid: Sorted uint64 array of solid k-mers (both strands)
+        rounds: Maximum number of correction rounds
+
+    Returns:
+        (corrected reads, number of bases changed)
+    """
+    corrected = list(reads)
+    todo = list(range(len(reads)))
+    n_fixed = 0
+    for _ in range(rounds):
+        if not todo:
+            break
+        batch = [corrected[i] for i in todo]
+        changed, n = _correct_round(batch, k, solid)
+        n_fixed += n
+        for j in changed:
+            corrected[todo[j]] = batch[j]
+        todo = [todo[j] for j in changed]
+    return corrected, n_fixed
+
+
+def _correct_shared(reads, k):
+    # the solid k-mers are shared with the correction workers
+    return correct_batch(reads, k, shared_object())
+
+
+class CorrectedReads:
+    """
+    Reads of a collection with isolated errors corrected, streamed batch by batch
+
+    Every iteration corrects the reads afresh, so a build can pass over them
+    several times without keeping corrected reads around.
+
+    Args:
+        data: Collection of reads, e.g. utils.FastaReads
+        k: k-mer length of the spectrum
+        solid: Sorted uint64 array of solid k-mers
+        workers: Number of worker processes correcting batches
+    """
+    def __init__(self, data, k, solid, workers=1, batch_reads=BATCH_READS):
+        self.data = data
+        self.k = k
+        self.solid = solid
+        self.workers = workers
+        self.batch_reads = batch_reads
+        self.n_corrected = 0
+
+    def __iter__(self):
+        self.n_corrected = 0
+        batches = iter_batches(self.data, self.batch_reads)
+        if self.workers <= 1:
+            for reads in batches:
+                corrected, n = correct_batch(reads, self.k, self.solid)
+                self.n_corrected += n
+                yield from corrected
+            return
+        with worker_pool(self.workers, self.solid) as pool:
+            tasks = ((reads, self.k) for reads in batches)
+            for corrected, n in map_rounds(pool, _correct_shared, tasks, self.workers):
+                self.n_corrected += n
+                yield from corrected
+
+
+def correct_data(data_list, k, min_count=2, workers=1, bloom_bits=BLOOM_BITS):
+    """
+    Error-corrected views of a data list, sharing one solid k-mer spectrum
+
+    Args:
+        data_list: Re-iterable collections of reads, as passed to DBG
+        k: k-mer length (at most 32)
+        min_count: Occurrences of a solid k-mer
+        workers: Number of worker processes correcting batches
+        bloom_bits: Size of the Bloom filter of the spectrum pass
+
+    Returns:
+        List of CorrectedReads, one per collection
+    """
+    solid = solid_kmers(data_list, k, min_count, bloom_bits)
+    return [CorrectedReads(data, k, solid, workers) for data in data_list]
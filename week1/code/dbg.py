@@ -1,3 +1,29 @@
+import heapq
+import json
+import logging
+import os
+
+import numpy as np
+
+from kmer import BASES, PackedKmerIndex, decode_kmer, edge_codes, find_sorted, iter_edges
+from kmer_count import BLOOM_BITS, count_external, count_parallel, solid_kmers
+from utils import BATCH_READS, iter_batches, shared_object, worker_pool
+
+logger = logging.getLogger(__name__)
+
+# bubble branches whose lengths differ by at most this fraction are collapsed
+BUBBLE_LENGTH_DIFF = 0.1
+SNAPSHOT_VERSION = 2
+# arrays of a snapshot that traversal never writes; they are memory-mapped on load
+_SNAPSHOT_READ_ONLY = ('counts', 'lengths', '_child_ptr', '_children', '_parent_ptr', '_parents')
+# component batches handed to each extraction worker, for load balancing
+TASKS_PER_WORKER = 4
+# nodes converted to Python ints at a time by the depth search
+SEARCH_CHUNK = 1 << 16
+
+_LAST_BASE = np.frombuffer(BASES.encode('ascii'), dtype=np.uint8)
+
+
 def reverse_complement(key):
     complement = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
 
@@ -7,130 +33,650 @@ def reverse_complement(key):
     return ''.join(key)
 
 
-class Node:
-    def __init__(self, kmer):
-        self._children = set()
-        self._count = 0
-        self.kmer = kmer
-        self.visited = False
-        self.depth = 0
-        self.max_depth_child = None
+def graph_options(compact=False, min_count=1, simplify=False, **_):
+    """
+    The DBG arguments that change the graph, as stored with a snapshot
 
-    def add_child(self, kmer):
-        self._children.add(kmer)
+    Args:
+        compact, min_count, simplify: As passed to DBG; other arguments are ignored
 
-    def increase(self):
-        self._count += 1
+    Returns:
+        Dictionary of the options, with compact set whenever simplify is
+    """
+    return {'compact': bool(compact or simplify), 'min_count': min_count, 'simplify': bool(simplify)}
 
-    def reset(self):
-        self.visited = False
-        self.depth = 0
-        self.max_depth_child = None
 
-    def get_count(self):
-        return self._count
+def _csr(src, dst, n, rank=None):
+    # row pointers and column indices of the arcs src -> dst; each row is in
+    # index order, or by rank (then index) when given
+    order = np.lexsort((dst, src)) if rank is None else np.lexsort((dst, rank[dst], src))
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=ptr[1:])
+    return ptr, dst[order].astype(np.int32)
 
-    def get_children(self):
-        return list(self._children)
 
-    def remove_children(self, target):
-        self._children = self._children - target
+class DBG:
+    """
+    De Bruijn graph stored as arrays indexed by node
 
+    Per node: count, coverage, length (k-mers in the node), alive flag and the
+    traversal fields depth, visited, best_child (-1 for none) and truncated (the
+    depth search cut a cycle at or below the node). Children and parents are
+    kept in CSR form and never rewritten after the build; deleted nodes are only
+    marked dead. Children are stored in the order traversal visits them: highest
+    count first, then lowest index. The original implementation broke count ties
+    in Python set order, so contigs that choose between equal-count branches
+    differ from its output.
 
-class DBG:
-    def __init__(self, k, data_list):
+    With min_count > 1 only solid k-mers, occurring at least min_count times,
+    and the arcs between them enter the graph. They are found in passes over the
+    reads before the build (see kmer_count.solid_kmers), so the reads must be
+    re-iterable.
+
+    simplify clips tips and pops bubbles of the compacted graph before traversal.
+    The arguments that shape the graph are kept in options (see graph_options)
+    and saved with snapshots.
+
+    With memory_mb set, k-mers are counted out of core in bucket files under
+    tmp_dir (see kmer_count.count_external) before the graph is built.
+    """
+    def __init__(self, k, data_list, packed=False, compact=False, workers=1,
+                 min_count=1, bloom_bits=BLOOM_BITS, simplify=False, memory_mb=None, tmp_dir=None):
         self.k = k
-        self.nodes = {}
+        self.packed = packed
+        self.options = graph_options(compact, min_count, simplify)
         # private
-        self.kmer2idx = {}
+        # k-mers are keyed on 2-bit codes; packed mode (k <= 32) keeps them in a
+        # NumPy uint64 index instead of a dict
+        self.kmer2idx = PackedKmerIndex(k) if packed else {}
         self.kmer_count = 0
+        self._codes = []
+        self._arc_keys = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        # last bases of the k-mers merged into a unitig, by unitig index
+        self._suffixes = {}
+        # traversal state kept across get_longest_contig calls: candidate runs of
+        # [nodes, depths, read position] sorted deepest first, nodes to search
+        self._runs = []
+        self._stale = None
+        # truncated nodes by component label, and the label of every node (see
+        # _components); labels stay valid since deletions only split components
+        self._cut = {}
+        self._component = None
+        # sorted codes of the k-mers allowed into the graph, None for all
+        self._solid = None
         # build
         self._check(data_list)
-        self._build(data_list)
+        if min_count > 1:
+            if not packed or workers > 1:
+                raise ValueError("Solid k-mer filtering requires a serial packed build")
+            self._solid = solid_kmers(data_list, k, min_count, bloom_bits, BATCH_READS)
+        if memory_mb is not None:
+            if not packed or workers > 1:
+                raise ValueError("Out-of-core counting requires a serial packed build")
+            self._build_counted(*count_external(data_list, k, memory_mb, tmp_dir, BATCH_READS,
+                                                self._solid))
+        elif workers > 1:
+            if not packed:
+                raise ValueError("A parallel build requires packed k-mers")
+            self._build_counted(*count_parallel(data_list, k, workers, BATCH_READS))
+        else:
+            self._build(data_list)
+        self._finish_build()
+        if compact or simplify:
+            self._compact()
+        if simplify:
+            self._simplify()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
 
     def _check(self, data_list):
-        # check data list
+        # check data list; streamed reads cannot be inspected before the build
         assert len(data_list) > 0
-        assert self.k <= len(data_list[0][0])
+        if isinstance(data_list[0], list):
+            assert self.k <= len(data_list[0][0])
 
     def _build(self, data_list):
         for data in data_list:
-            for original in data:
-                rc = reverse_complement(original)
-                for i in range(len(original) - self.k - 1):
-                    self._add_arc(original[i: i + self.k], original[i + 1: i + 1 + self.k])
-                    self._add_arc(rc[i: i + self.k], rc[i + 1: i + 1 + self.k])
+            for reads in iter_batches(data, BATCH_READS):
+                if self.packed:
+                    codes = edge_codes(reads, self.k)
+                    if self._solid is not None:
+                        solid = find_sorted(self._solid, codes)[1].reshape(-1, 2).all(axis=1)
+                        codes = codes.reshape(-1, 2)[solid].reshape(-1)
+                    ids = self.kmer2idx.add(codes)
+                    self.kmer_count = len(self.kmer2idx)
+                else:
+                    ids = np.fromiter((self._add_node(kmer) for read in reads
+                                       for arc in iter_edges(read, self.k) for kmer in arc),
+                                      dtype=np.int64)
+                self._add_batch(ids[0::2], ids[1::2])
+
+    def _build_counted(self, kmers, counts, arc_src, arc_dst):
+        # graph from counted tables; kmers come in order of first occurrence
+        self.kmer2idx.add(kmers)
+        self.kmer_count = len(self.kmer2idx)
+        self.counts = counts.astype(np.int64)
+        self._add_arcs(self.kmer2idx.lookup(arc_src), self.kmer2idx.lookup(arc_dst))
 
     def _add_node(self, kmer):
         if kmer not in self.kmer2idx:
             self.kmer2idx[kmer] = self.kmer_count
-            self.nodes[self.kmer_count] = Node(kmer)
+            self._codes.append(kmer)
             self.kmer_count += 1
-        idx = self.kmer2idx[kmer]
-        self.nodes[idx].increase()
-        return idx
+        return self.kmer2idx[kmer]
+
+    def _add_batch(self, src, dst):
+        # every arc adds one to the count of both of its k-mers; the count array
+        # grows geometrically, so batches do not copy it every time
+        ids, counts = np.unique(np.concatenate([src, dst]), return_counts=True)
+        if self.kmer_count > len(self.counts):
+            self.counts = np.pad(self.counts, (0, max(self.kmer_count, 2 * len(self.counts)) - len(self.counts)))
+        self.counts[ids] += counts
+        self._add_arcs(src, dst)
+
+    def _add_arcs(self, src, dst):
+        # arcs are collected as (src << 32 | dst) keys and deduplicated
+        self._arc_keys.append(np.unique((src.astype(np.uint64) << 32) | dst.astype(np.uint64)))
+
+    def _finish_build(self):
+        n = self.kmer_count
+        assert n < 2 ** 31, "Node indices must fit in 32 bits"
+        keys = np.unique(np.concatenate(self._arc_keys)) if self._arc_keys \
+            else np.zeros(0, dtype=np.uint64)
+        self._arc_keys = []
+        self._solid = None
+        self.arc_count = len(keys)
+        self.counts = np.pad(self.counts[:n], (0, max(n - len(self.counts), 0)))
+        self._set_arcs((keys >> 32).astype(np.int64), (keys & 0xFFFFFFFF).astype(np.int64))
+
+        self.coverage = self.counts.copy()
+        self.lengths = np.ones(n, dtype=np.int32)
+        self.alive = np.ones(n, dtype=bool)
+        self.visited = np.zeros(n, dtype=bool)
+        self.depth = np.zeros(n, dtype=np.int32)
+        self.best_child = np.full(n, -1, dtype=np.int32)
+        self.truncated = np.zeros(n, dtype=bool)
+
+    def _set_arcs(self, src, dst):
+        self._child_ptr, self._children = _csr(src, dst, self.kmer_count, -self.counts)
+        self._parent_ptr, self._parents = _csr(dst, src, self.kmer_count)
+
+    def get_children(self, idx):
+        children = self._children[self._child_ptr[idx]: self._child_ptr[idx + 1]].tolist()
+        return [child for child in children if self.alive[child]]
+
+    def get_parents(self, idx):
+        parents = self._parents[self._parent_ptr[idx]: self._parent_ptr[idx + 1]].tolist()
+        return [parent for parent in parents if self.alive[parent]]
+
+    def _alive_arcs(self):
+        src = np.repeat(np.arange(self.kmer_count), np.diff(self._child_ptr))
+        dst = self._children.astype(np.int64)
+        alive = self.alive[src] & self.alive[dst]
+        return src[alive], dst[alive]
+
+    def _compact(self):
+        # merge non-branching runs into unitig nodes; a unitig keeps the index
+        # and count of its first k-mer, which is what traversal compares
+        n = self.kmer_count
+        src, dst = self._alive_arcs()
+        out_degree = np.bincount(src, minlength=n)
+        in_degree = np.bincount(dst, minlength=n)
+        # src -> dst is a link inside a unitig when it is the only arc of both
+        link = (out_degree[src] == 1) & (in_degree[dst] == 1) & (src != dst)
+        next_node = np.full(n, -1, dtype=np.int64)
+        next_node[src[link]] = dst[link]
+        has_prev = np.zeros(n, dtype=bool)
+        has_prev[dst[link]] = True
+
+        # walk every run from its first node; runs that close into a cycle have
+        # no first node and start at their lowest index
+        head = np.arange(n)
+        next_list = next_node.tolist()
+        starts = np.flatnonzero(~has_prev & (next_node != -1)).tolist()
+        for start in starts + np.flatnonzero(has_prev).tolist():
+            if head[start] != start:
+                continue
+            members = [start]
+            idx = next_list[start]
+            while idx != -1 and idx != start:
+                members.append(idx)
+                idx = next_list[idx]
+            head[members] = start
+            self._merge(start, np.array(members))
+
+        # arcs leaving a unitig start at its last k-mer; links and arcs into
+        # merged k-mers disappear
+        keep = head[dst] == dst
+        self._set_arcs(head[src[keep]], dst[keep])
+        return int(np.count_nonzero(head != np.arange(n)))
+
+    def _merge(self, idx, members):
+        codes = self.kmer2idx.code(members[1:]) if self.packed \
+            else np.array([self._codes[member] for member in members[1:]], dtype=object)
+        suffix = _LAST_BASE[(codes & 3).astype(np.int64)].tobytes().decode('ascii')
+        # merging unitigs again (after simplification) carries their suffixes along
+        if self.lengths[members].max() > 1:
+            suffix = ''.join(base + self._suffixes.pop(member, '')
+                             for base, member in zip(suffix, members[1:].tolist()))
+        self._suffixes[idx] = self._suffixes.get(idx, '') + suffix
+        self.coverage[idx] = self.coverage[members].sum()
+        self.lengths[idx] = self.lengths[members].sum()
+        self.alive[members[1:]] = False
+
+    def _degrees(self):
+        # degrees over alive arcs, and the parent and child of every node with a
+        # single one (arbitrary otherwise)
+        n = self.kmer_count
+        src, dst = self._alive_arcs()
+        parent = np.full(n, -1, dtype=np.int64)
+        parent[dst] = src
+        child = np.full(n, -1, dtype=np.int64)
+        child[src] = dst
+        return np.bincount(dst, minlength=n), np.bincount(src, minlength=n), parent, child
+
+    def _simplify(self, max_tip_len=None):
+        # repeat until nothing changes: clipping and popping leave non-branching
+        # runs that are compacted, which can expose new tips and bubbles
+        max_tip_len = 2 * self.k if max_tip_len is None else max_tip_len
+        while True:
+            tips, tip_kmers = self._clip_tips(max_tip_len)
+            logger.info("Clipped %d tips (%d k-mers)", tips, tip_kmers)
+            bubbles, bubble_kmers = self._pop_bubbles()
+            logger.info("Popped %d bubble branches (%d k-mers)", bubbles, bubble_kmers)
+            if tips == 0 and bubbles == 0:
+                break
+            self._compact()
 
-    def _add_arc(self, kmer1, kmer2):
-        idx1 = self._add_node(kmer1)
-        idx2 = self._add_node(kmer2)
-        self.nodes[idx1].add_child(idx2)
+    def _clip_tips(self, max_len):
+        # a tip is a unitig of fewer than max_len k-mers without children whose only
+        # parent has other children, or the same with parents and children swapped
+        in_degree, out_degree, parent, child = self._degrees()
+        short = self.alive & (self.lengths < max_len)
+        sinks = np.flatnonzero(short & (out_degree == 0) & (in_degree == 1))
+        sinks = sinks[out_degree[parent[sinks]] > 1]
+        sources = np.flatnonzero(short & (in_degree == 0) & (out_degree == 1))
+        sources = sources[in_degree[child[sources]] > 1]
+        tips = np.concatenate([self._spare_best(sinks, parent[sinks], out_degree),
+                               self._spare_best(sources, child[sources], in_degree)])
+        self.alive[tips] = False
+        return len(tips), int(self.lengths[tips].sum())
 
-    def _get_count(self, child):
-        return self.nodes[child].get_count()
+    def _spare_best(self, nodes, anchors, degree):
+        # when every branch at an anchor is a tip, the best covered one (lowest
+        # index on ties) is not a tip but the end of the path
+        order = np.lexsort((nodes, -self.coverage[nodes], anchors))
+        nodes, anchors = nodes[order], anchors[order]
+        first = np.ones(len(nodes), dtype=bool)
+        first[1:] = anchors[1:] != anchors[:-1]
+        n_tips = np.bincount(anchors, minlength=self.kmer_count)[anchors]
+        return nodes[~(first & (n_tips == degree[anchors]))]
 
-    def _get_sorted_children(self, idx):
-        children = self.nodes[idx].get_children()
-        children.sort(key=self._get_count, reverse=True)
-        return children
+    def _pop_bubbles(self, max_diff=BUBBLE_LENGTH_DIFF):
+        # unitigs that all lead from the same node to the same node and have
+        # similar lengths are parallel paths; all but the one with the highest
+        # coverage per k-mer are removed and their coverage moves to it
+        in_degree, out_degree, parent, child = self._degrees()
+        branches = np.flatnonzero(self.alive & (in_degree == 1) & (out_degree == 1))
+        starts, ends = parent[branches], child[branches]
+        simple = (starts != ends) & (starts != branches) & (ends != branches)
+        branches, starts, ends = branches[simple], starts[simple], ends[simple]
+        mean_coverage = self.coverage[branches] / self.lengths[branches]
+        order = np.lexsort((branches, -mean_coverage, ends, starts))
+        branches, starts, ends = branches[order], starts[order], ends[order]
+
+        first = np.ones(len(branches), dtype=bool)
+        first[1:] = (starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1])
+        kept = branches[np.maximum.accumulate(np.where(first, np.arange(len(branches)), 0))]
+        lengths, kept_lengths = self.lengths[branches], self.lengths[kept]
+        popped = ~first & (np.abs(lengths - kept_lengths) <= max_diff * kept_lengths)
+        np.add.at(self.coverage, kept[popped], self.coverage[branches[popped]])
+        self.alive[branches[popped]] = False
+        return int(np.count_nonzero(popped)), int(lengths[popped].sum())
+
+    def save(self, path):
+        """
+        Write the graph to a snapshot directory, one .npy file per array
+
+        meta.json records the format version, k and options. Traversal state is
+        not saved: a loaded graph searches its alive nodes afresh, so a snapshot
+        taken after extracting contigs stays consistent.
+
+        Args:
+            path: Directory, created if needed
+        """
+        if not self.packed:
+            raise ValueError("Snapshots require packed k-mers")
+        os.makedirs(path, exist_ok=True)
+        arrays = {name: getattr(self, name) for name in _SNAPSHOT_READ_ONLY + ('coverage', 'alive')}
+        arrays.update(self.kmer2idx.state())
+        suffix_ids = np.array(sorted(self._suffixes), dtype=np.int64)
+        suffixes = [self._suffixes[idx] for idx in suffix_ids.tolist()]
+        arrays['suffix_ids'] = suffix_ids
+        arrays['suffix_ptr'] = np.cumsum([0] + [len(suffix) for suffix in suffixes], dtype=np.int64)
+        arrays['suffix_bases'] = np.frombuffer(''.join(suffixes).encode('ascii'), dtype=np.uint8)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name.lstrip('_') + '.npy'), array)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'k': self.k, 'options': self.options}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Graph from a snapshot directory written by save, without reading any reads
+
+        Args:
+            path: Snapshot directory
+            mmap: Memory-map the arrays traversal only reads instead of loading them
+
+        Returns:
+            DBG ready for get_longest_contig
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {meta['version']}")
+
+        def load_array(name, mmap_mode='r' if mmap else None):
+            return np.load(os.path.join(path, name.lstrip('_') + '.npy'), mmap_mode=mmap_mode)
+
+        dbg = cls.__new__(cls)
+        dbg.k = meta['k']
+        dbg.packed = True
+        dbg.options = meta['options']
+        dbg.kmer2idx = PackedKmerIndex.from_state(dbg.k, {name: load_array(name)
+                                                          for name in ('keys', 'ids', 'codes')})
+        dbg.kmer_count = len(dbg.kmer2idx)
+        dbg._codes = []
+        dbg._arc_keys = []
+        dbg._solid = None
+        for name in _SNAPSHOT_READ_ONLY:
+            setattr(dbg, name, load_array(name))
+        dbg.arc_count = len(dbg._children)
+        dbg.coverage = load_array('coverage', None)
+        dbg.alive = load_array('alive', None)
+        ptr = load_array('suffix_ptr', None)
+        bases = load_array('suffix_bases', None).tobytes().decode('ascii')
+        dbg._suffixes = {idx: bases[start: end] for idx, start, end
+                         in zip(load_array('suffix_ids', None).tolist(), ptr[:-1].tolist(), ptr[1:].tolist())}
+        dbg.visited = np.zeros(dbg.kmer_count, dtype=bool)
+        dbg.depth = np.zeros(dbg.kmer_count, dtype=np.int32)
+        dbg.best_child = np.full(dbg.kmer_count, -1, dtype=np.int32)
+        dbg.truncated = np.zeros(dbg.kmer_count, dtype=bool)
+        dbg._runs = []
+        dbg._stale = None
+        dbg._cut = {}
+        dbg._component = None
+        return dbg
 
     def _get_depth(self, idx):
-        if not self.nodes[idx].visited:
-            self.nodes[idx].visited = True
-            children = self._get_sorted_children(idx)
-            max_depth, max_child = 0, None
-            for child in children:
-                depth = self._get_depth(child)
-                if depth > max_depth:
-                    max_depth, max_child = depth, child
-            self.nodes[idx].depth, self.nodes[idx].max_depth_child = max_depth + 1, max_child
-        return self.nodes[idx].depth
+        # depth-first search with parallel stacks of node, position of its next
+        # child in the CSR row, max depth, max child and whether a cycle was cut
+        # below; rows are already in visiting order and dead children are skipped
+        # in place. A child still on the stack (visited, depth not yet set) counts
+        # with depth 0
+        if self.visited[idx]:
+            return int(self.depth[idx])
+        ptr, children, lengths = self._child_ptr, self._children, self.lengths
+        alive, visited, depth, truncated = self.alive, self.visited, self.depth, self.truncated
+        visited[idx] = True
+        nodes, positions, max_depths, max_children, cuts = [idx], [int(ptr[idx])], [0], [-1], [False]
+        while nodes:
+            node = nodes[-1]
+            pos, end = positions[-1], int(ptr[node + 1])
+            while pos < end:
+                child = int(children[pos])
+                pos += 1
+                if not alive[child]:
+                    continue
+                if not visited[child]:
+                    visited[child] = True
+                    positions[-1] = pos
+                    nodes.append(child)
+                    positions.append(int(ptr[child]))
+                    max_depths.append(0)
+                    max_children.append(-1)
+                    cuts.append(False)
+                    break
+                if depth[child] == 0 or truncated[child]:
+                    cuts[-1] = True
+                if depth[child] > max_depths[-1]:
+                    max_depths[-1], max_children[-1] = int(depth[child]), child
+            else:
+                nodes.pop()
+                positions.pop()
+                node_depth = max_depths.pop() + int(lengths[node])
+                depth[node], self.best_child[node], truncated[node] = node_depth, max_children.pop(), cuts.pop()
+                if nodes:
+                    cuts[-1] = cuts[-1] or truncated[node]
+                    if node_depth > max_depths[-1]:
+                        max_depths[-1], max_children[-1] = node_depth, node
+        return int(depth[idx])
+
+    def _reset_node(self, idx):
+        self.visited[idx] = False
+        self.depth[idx] = 0
+        self.best_child[idx] = -1
+        self.truncated[idx] = False
 
     def _reset(self):
-        for idx in self.nodes.keys():
-            self.nodes[idx].reset()
+        # forget all depths, the next traversal recomputes the whole graph
+        self.visited[:] = False
+        self.depth[:] = 0
+        self.best_child[:] = -1
+        self.truncated[:] = False
+        self._runs = []
+        self._stale = None
+        self._cut = {}
+
+    def _search(self, nodes):
+        # depths of the alive given nodes, searched in index order, then one more
+        # run of candidates sorted deepest first, lowest index on ties
+        nodes = nodes[self.alive[nodes]]
+        visited = self.visited
+        for start in range(0, len(nodes), SEARCH_CHUNK):
+            for idx in nodes[start: start + SEARCH_CHUNK].tolist():
+                if not visited[idx]:
+                    self._get_depth(idx)
+
+        # truncated nodes are kept by component, see _delete_path
+        cut = nodes[self.truncated[nodes]]
+        if len(cut):
+            if self._component is None:
+                self._component = self._components()
+            label = self._component[cut]
+            order = np.argsort(label, kind='stable')
+            cut, label = cut[order], label[order]
+            bounds = np.flatnonzero(np.diff(label)) + 1
+            for group, group_label in zip(np.split(cut, bounds), label[np.r_[0, bounds]].tolist()):
+                self._cut[group_label] = np.union1d(self._cut.get(group_label, group), group)
+
+        depths = self.depth[nodes]
+        order = np.lexsort((nodes, -depths))
+        self._runs.append([nodes[order].astype(np.int32), depths[order], 0])
+        # merge runs no larger than the next one, so they stay few
+        while len(self._runs) > 1 and len(self._runs[-2][0]) - self._runs[-2][2] \
+                <= len(self._runs[-1][0]) - self._runs[-1][2]:
+            (nodes_a, depths_a, pos_a), (nodes_b, depths_b, pos_b) = self._runs.pop(-2), self._runs.pop()
+            nodes = np.concatenate([nodes_a[pos_a:], nodes_b[pos_b:]])
+            depths = np.concatenate([depths_a[pos_a:], depths_b[pos_b:]])
+            order = np.lexsort((nodes, -depths))
+            self._runs.append([nodes[order], depths[order], 0])
 
     def _get_longest_path(self):
-        max_depth, max_idx = 0, None
-        for idx in self.nodes.keys():
-            depth = self._get_depth(idx)
-            if depth > max_depth:
-                max_depth, max_idx = depth, idx
+        # only nodes without a valid depth are searched: every node on the first call,
+        # afterwards the nodes invalidated by _delete_path
+        if self._stale is None:
+            self._search(np.flatnonzero(self.alive))
+        elif self._stale:
+            self._search(np.unique(np.concatenate(self._stale)))
+        self._stale = []
+
+        # deepest node, lowest index first on ties, over the heads of all runs;
+        # outdated entries are skipped
+        alive, visited, depth = self.alive, self.visited, self.depth
+        best = None
+        for run in self._runs:
+            nodes, depths, pos = run
+            while pos < len(nodes) and not (alive[nodes[pos]] and visited[nodes[pos]]
+                                            and depth[nodes[pos]] == depths[pos]):
+                pos += 1
+            run[2] = pos
+            if pos < len(nodes) and (best is None or (-depths[pos], nodes[pos]) < best):
+                best = (-depths[pos], nodes[pos])
+        self._runs = [run for run in self._runs if run[2] < len(run[0])]
 
         path = []
-        while max_idx is not None:
+        max_idx = -1 if best is None else int(best[1])
+        while max_idx != -1:
             path.append(max_idx)
-            max_idx = self.nodes[max_idx].max_depth_child
+            max_idx = int(self.best_child[max_idx])
         return path
 
     def _delete_path(self, path):
-        for idx in path:
-            del self.nodes[idx]
-        path_set = set(path)
-        for idx in self.nodes.keys():
-            self.nodes[idx].remove_children(path_set)
+        if path:
+            # a depth cut at a cycle depends on where the search entered the cycle,
+            # which a deletion anywhere in the component can change: all truncated
+            # nodes of the component are searched afresh
+            reset = self._cut.pop(int(self._component[path[0]]), None) if self._cut else None
+            if reset is not None:
+                self._reset_node(reset)
+                self._stale.append(reset)
+        self.alive[path] = False
+        # invalidate every node whose max depth chain runs into the path,
+        # found through the parents of the deleted and invalidated nodes
+        queue, stale = list(path), []
+        while queue:
+            idx = queue.pop()
+            for parent in self.get_parents(idx):
+                if self.best_child[parent] == idx:
+                    self._reset_node(parent)
+                    stale.append(parent)
+                    queue.append(parent)
+        self._stale.append(np.array(stale, dtype=np.int64))
+
+    def _get_code(self, idx):
+        if self.packed:
+            return self.kmer2idx.code(idx)
+        return self._codes[idx]
 
     def _concat_path(self, path):
         if len(path) < 1:
             return None
-        concat = self.nodes[path[0]].kmer
-        for i in range(1, len(path)):
-            concat += self.nodes[path[i]].kmer[-1]
-        return concat
+        # strings are only rebuilt here, when a contig is emitted
+        bases = [decode_kmer(self._get_code(path[0]), self.k), self._suffixes.get(path[0], '')]
+        for idx in path[1:]:
+            bases.append(BASES[self._get_code(idx) & 3])
+            bases.append(self._suffixes.get(idx, ''))
+        return ''.join(bases)
 
     def get_longest_contig(self):
-        # reset params in nodes for getting longest path
-        self._reset()
         path = self._get_longest_path()
         contig = self._concat_path(path)
         self._delete_path(path)
         return contig
+
+    def _components(self):
+        # weakly connected component label (its lowest node index) of every node:
+        # hook the higher root of every arc onto the lower, then jump pointers
+        # until every node points at its root
+        src, dst = self._alive_arcs()
+        label = np.arange(self.kmer_count)
+        while True:
+            src_label, dst_label = label[src], label[dst]
+            apart = src_label != dst_label
+            if not apart.any():
+                return label
+            low = np.minimum(src_label[apart], dst_label[apart])
+            high = np.maximum(src_label[apart], dst_label[apart])
+            np.minimum.at(label, high, low)
+            while True:
+                jumped = label[label]
+                if np.array_equal(jumped, label):
+                    break
+                label = jumped
+
+    def get_longest_contigs(self, n, workers=1):
+        """
+        The n contigs that n calls of get_longest_contig would return, in the same order
+
+        Paths never cross weakly connected components, so with several workers each
+        component yields its own longest paths in a worker process, and a priority
+        merge on (depth, start index) restores the global order. Traversal state
+        starts afresh on the next get_longest_contig call.
+
+        Args:
+            n: Maximum number of contigs
+            workers: Number of worker processes
+
+        Returns:
+            Contigs, longest first
+        """
+        if workers <= 1:
+            contigs = []
+            for _ in range(n):
+                c = self.get_longest_contig()
+                if c is None:
+                    break
+                contigs.append(c)
+            return contigs
+
+        # workers search from scratch; their deletions stay in their own copies
+        self._reset()
+        nodes = np.flatnonzero(self.alive)
+        self._component = self._components()
+        label = self._component[nodes]
+        order = np.lexsort((nodes, label))
+        nodes, label = nodes[order], label[order]
+        components = np.split(nodes, np.flatnonzero(np.diff(label)) + 1) if len(nodes) else []
+        # largest components first, bundled so every task holds a similar number of nodes
+        components.sort(key=len, reverse=True)
+        task_nodes = max(len(nodes) // (TASKS_PER_WORKER * workers), 1)
+        tasks, task, size = [], [], 0
+        for component in components:
+            task.append(component)
+            size += len(component)
+            if size >= task_nodes:
+                tasks.append(task)
+                task, size = [], 0
+        if task:
+            tasks.append(task)
+        with worker_pool(workers, self) as pool:
+            results = [paths for task_paths in pool.starmap(_extract_paths, [(task, n) for task in tasks])
+                       for paths in task_paths]
+
+        # merge: the next path of every component competes on depth, then start index
+        heap = [(-paths[0][0], paths[0][1][0], i, 0) for i, paths in enumerate(results) if paths]
+        heapq.heapify(heap)
+        contigs = []
+        while heap and len(contigs) < n:
+            _, _, i, j = heapq.heappop(heap)
+            path = results[i][j][1]
+            contigs.append(self._concat_path(path))
+            self.alive[path] = False
+            if j + 1 < len(results[i]):
+                depth, next_path = results[i][j + 1]
+                heapq.heappush(heap, (-depth, next_path[0], i, j + 1))
+        self._reset()
+        return contigs
+
+
+def _extract_paths(components, n):
+    # up to n (depth, path) pairs per component, in the order get_longest_contig
+    # would find them; components are searched one at a time
+    dbg = shared_object()  # the graph is shared with the extraction workers
+    results = []
+    for nodes in components:
+        dbg._runs = []
+        dbg._stale = [nodes]
+        paths = []
+        for _ in range(n):
+            path = dbg._get_longest_path()
+            if not path:
+                break
+            paths.append((int(dbg.depth[path[0]]), path))
+            dbg._delete_path(path)
+        results.append(paths)
+    return results
@@ -0,0 +1,285 @@
+import numpy as np
+
+BASES = 'ACGT'
+
+# 2-bit code per base; complement of code b is 3 - b
+_BASE_CODE = np.full(256, 255, dtype=np.uint8)
+for _code, _base in enumerate(BASES):
+    _BASE_CODE[ord(_base)] = _code
+_CODES = bytes(range(4))
+_TO_CODE = bytes.maketrans(BASES.encode('ascii'), _CODES)
+_TO_COMPLEMENT_CODE = bytes.maketrans(BASES.encode('ascii'), _CODES[::-1])
+
+
+def encode_kmer(kmer):
+    code = 0
+    for base in kmer:
+        code = (code << 2) | BASES.index(base)
+    return code
+
+
+def decode_kmer(code, k):
+    code = int(code)
+    bases = [''] * k
+    for i in range(k - 1, -1, -1):
+        bases[i] = BASES[code & 3]
+        code >>= 2
+    return ''.join(bases)
+
+
+def iter_edges(seq, k):
+    """
+    Stream the arcs of a read as (kmer1, kmer2) code pairs
+
+    The forward window and the window of the reverse complement are updated in O(1)
+    per base, so no k-mer strings are allocated. Arcs come out in the order DBG._build
+    adds them: forward arc i, then reverse-complement arc i.
+
+    Args:
+        seq: Read sequence
+        k: k-mer length (any k; codes are Python ints)
+
+    Yields:
+        Pairs of integer k-mer codes
+    """
+    mask = (1 << (2 * k)) - 1
+    fwd_bases = seq.encode('ascii').translate(_TO_CODE)
+    if fwd_bases.translate(None, _CODES):
+        raise ValueError("Sequence contains bases other than A, C, G and T")
+    # the reverse complement is read from the end of the sequence, so both
+    # strands complete window i at the same step
+    rc_bases = seq[::-1].encode('ascii').translate(_TO_COMPLEMENT_CODE)
+    fwd = rc = 0
+    prev_fwd = prev_rc = 0
+    for j, (base, rc_base) in enumerate(zip(fwd_bases[:-1], rc_bases)):
+        fwd = ((fwd << 2) | base) & mask
+        rc = ((rc << 2) | rc_base) & mask
+        if j >= k:
+            yield prev_fwd, fwd
+            yield prev_rc, rc
+        prev_fwd, prev_rc = fwd, rc
+
+
+def encode_bases(seq):
+    """
+    Convert a sequence (or a concatenation of sequences) into an array of 2-bit base codes
+    """
+    codes = _BASE_CODE[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+    if (codes > 3).any():
+        raise ValueError("Sequence contains bases other than A, C, G and T")
+    return codes
+
+
+def rolling_codes(bases, k):
+    """
+    Packed codes of every window of k bases and of the window's reverse complement
+
+    Args:
+        bases: Array of 2-bit base codes, as returned by encode_bases
+        k: k-mer length (at most 32)
+
+    Returns:
+        (fwd, rc) uint64 arrays, one code per window start
+    """
+    bases = bases.astype(np.uint64)
+    n_windows = max(len(bases) - k + 1, 0)
+    fwd = np.zeros(n_windows, dtype=np.uint64)
+    rc = np.zeros(n_windows, dtype=np.uint64)
+    for j in range(k):
+        window = bases[j: j + n_windows]
+        fwd = (fwd << 2) | window
+        rc |= (3 - window) << (2 * j)
+    return fwd, rc
+
+
+def read_kmers(reads, k):
+    """
+    Packed codes of all k-mers of a batch of reads, forward strand only
+
+    Args:
+        reads: List of read sequences
+        k: k-mer length (at most 32)
+
+    Returns:
+        (codes, read, position): uint64 codes with the index of their read and
+        their start in it
+    """
+    lengths = np.fromiter(map(len, reads), dtype=np.int64, count=len(reads))
+    n_kmers = np.maximum(lengths - k + 1, 0)
+    fwd, _ = rolling_codes(encode_bases(''.join(reads)), k)
+    read = np.repeat(np.arange(len(reads)), n_kmers)
+    position = np.arange(int(n_kmers.sum())) - np.repeat(np.cumsum(n_kmers) - n_kmers, n_kmers)
+    starts = np.cumsum(lengths) - lengths
+    return fwd[starts[read] + position], read, position
+
+
+def edge_codes(reads, k):
+    """
+    Packed k-mer codes for the arcs of a batch of reads
+
+    Args:
+        reads: List of read sequences
+        k: k-mer length (at most 32)
+
+    Returns:
+        uint64 array holding (kmer1, kmer2) pairs in the same order DBG._build
+        visits them: forward arc i, then reverse-complement arc i, for every read
+    """
+    lengths = np.fromiter(map(len, reads), dtype=np.int64, count=len(reads))
+    n_arcs = np.maximum(lengths - k - 1, 0)
+    total = int(n_arcs.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    fwd, rc = rolling_codes(encode_bases(''.join(reads)), k)
+
+    # arc i of a read starting at s with length L joins windows s + i -> s + i + 1 on the
+    # forward strand and the reverse complements of windows s + L - k - i -> s + L - k - i - 1
+    starts = np.cumsum(lengths) - lengths
+    read_start = np.repeat(starts, n_arcs)
+    read_len = np.repeat(lengths, n_arcs)
+    i = np.arange(total) - np.repeat(np.cumsum(n_arcs) - n_arcs, n_arcs)
+    f = read_start + i
+    r = read_start + read_len - k - i
+
+    codes = np.empty(4 * total, dtype=np.uint64)
+    codes[0::4] = fwd[f]
+    codes[1::4] = fwd[f + 1]
+    codes[2::4] = rc[r]
+    codes[3::4] = rc[r - 1]
+    return codes
+
+
+def window_codes(reads, k, codes=None):
+    """
+    Packed codes of every k-mer occurrence that takes part in an arc
+
+    Each read contributes its first L - k windows on both strands, i.e. the
+    first k-mer of every arc plus the second k-mer of the last arc per strand.
+
+    Args:
+        reads: List of read sequences
+        k: k-mer length (at most 32)
+        codes: edge_codes(reads, k), when already computed
+
+    Returns:
+        uint64 array with one code per occurrence
+    """
+    if codes is None:
+        codes = edge_codes(reads, k)
+    lengths = np.fromiter(map(len, reads), dtype=np.int64, count=len(reads))
+    n_arcs = np.maximum(lengths - k - 1, 0)
+    last = (np.cumsum(n_arcs) - 1)[n_arcs > 0]
+    return np.concatenate([codes[0::4], codes[2::4], codes[4 * last + 1], codes[4 * last + 3]])
+
+
+def find_sorted(keys, codes):
+    """
+    Position of every code in the sorted array keys, and whether it is there
+    """
+    pos = np.searchsorted(keys, codes)
+    pos[pos == len(keys)] = 0
+    if len(keys) == 0:
+        return pos, np.zeros(len(codes), dtype=bool)
+    return pos, keys[pos] == codes
+
+
+class PackedKmerIndex:
+    """
+    Maps 2-bit packed k-mers to node indices using sorted uint64 key arrays
+
+    Keys are held in sorted runs of decreasing size: a new run is merged into the
+    last one while that is not larger, so every key is merged O(log n) times and a
+    lookup searches O(log n) runs.
+    """
+    def __init__(self, k):
+        if k > 32:
+            raise ValueError("Packed k-mers require k <= 32")
+        self.k = k
+        self._runs = []
+        # codes by node index, in the chunks they were added in
+        self._code_chunks = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, code):
+        return self.lookup(np.array([code], dtype=np.uint64))[0] >= 0
+
+    def lookup(self, codes):
+        """
+        Node index for every code, -1 where the k-mer is unknown
+        """
+        codes = np.asarray(codes, dtype=np.uint64)
+        ids = np.full(len(codes), -1, dtype=np.int64)
+        for keys, run_ids in self._runs:
+            pos, found = find_sorted(keys, codes)
+            ids[found] = run_ids[pos[found]]
+        return ids
+
+    def add(self, codes):
+        """
+        Node index for every code; unknown k-mers get new indices in order of first occurrence
+        """
+        uniq, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        ids = self.lookup(uniq)
+        new = ids < 0
+        if new.any():
+            new_keys = uniq[new]
+            order = np.argsort(first[new], kind='stable')
+            new_ids = np.empty(len(new_keys), dtype=np.int64)
+            new_ids[order] = np.arange(len(self), len(self) + len(new_keys))
+            ids[new] = new_ids
+
+            self._code_chunks.append(new_keys[order])
+            self._size += len(new_keys)
+            self._add_run(new_keys, new_ids)
+        return ids[inverse.reshape(-1)]
+
+    def _add_run(self, keys, ids):
+        while self._runs and len(self._runs[-1][0]) <= len(keys):
+            last_keys, last_ids = self._runs.pop()
+            keys, ids = np.concatenate([last_keys, keys]), np.concatenate([last_ids, ids])
+            # both halves are sorted, which the stable sort merges in linear time
+            order = np.argsort(keys, kind='stable')
+            keys, ids = keys[order], ids[order]
+        self._runs.append((keys, ids))
+
+    def _codes(self):
+        if len(self._code_chunks) != 1:
+            self._code_chunks = [np.concatenate(self._code_chunks) if self._code_chunks
+                                 else np.zeros(0, dtype=np.uint64)]
+        return self._code_chunks[0]
+
+    def state(self):
+        """
+        Arrays holding the index, for saving it
+        """
+        if len(self._runs) > 1:
+            keys = np.concatenate([run[0] for run in self._runs])
+            order = np.argsort(keys, kind='stable')
+            self._runs = [(keys[order], np.concatenate([run[1] for run in self._runs])[order])]
+        keys, ids = self._runs[0] if self._runs else (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+        return {'keys': keys, 'ids': ids, 'codes': self._codes()}
+
+    @classmethod
+    def from_state(cls, k, state):
+        """
+        Index over arrays returned by state(), used as they are (e.g. memory-mapped)
+        """
+        index = cls(k)
+        if len(state['keys']):
+            index._runs = [(state['keys'], state['ids'])]
+        index._code_chunks = [state['codes']]
+        index._size = len(state['codes'])
+        return index
+
+    def code(self, idx):
+        # a single code as a Python int, or an array of codes for an array of indices
+        if np.ndim(idx):
+            return self._codes()[idx]
+        return int(self._codes()[idx])
+
+    def kmer(self, idx):
+        return decode_kmer(self._codes()[idx], self.k)
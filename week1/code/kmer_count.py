@@ -0,0 +1,353 @@
+import os
+import tempfile
+
+import numpy as np
+
+from kmer import edge_codes, find_sorted, window_codes
+from utils import BATCH_READS, iter_batches, map_rounds, worker_pool
+
+MINIMIZER_LEN = 11
+# odd 64-bit multiplier (golden ratio) scrambling m-mer codes before taking the minimum
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+# 2^30 bits (128 MiB) keep false positives below 1% up to ~200M distinct k-mers
+BLOOM_BITS = 1 << 30
+# odd multipliers of the Bloom filter hash functions (splitmix64 constants)
+_BLOOM_MULTIPLIERS = (0xBF58476D1CE4E5B9, 0x94D049BB133111EB, 0xD6E8FEB86659FD93)
+# out-of-core counting spills to 2^SPILL_BITS buckets by hash prefix; a bucket too
+# large for the memory budget is split again by the next SPLIT_BITS hash bits
+SPILL_BITS = 8
+SPLIT_BITS = 4
+_OCCURRENCE = np.dtype([('code', np.uint64), ('position', np.int64)])
+_ARC = np.dtype([('src', np.uint64), ('dst', np.uint64)])
+# encoding memory per read base: window codes, arc codes and their spill records
+_BYTES_PER_BASE = 160
+
+
+def minimizer_shards(codes, k, n_shards, m=MINIMIZER_LEN):
+    """
+    Shard of every k-mer, chosen by the hash of its minimizer
+
+    Consecutive k-mers of a read usually share their minimizer, so the arcs of a
+    read stay within few shards.
+
+    Args:
+        codes: uint64 array of packed k-mers
+        k: k-mer length
+        n_shards: Number of shards
+        m: Minimizer length
+
+    Returns:
+        int64 array of shard ids
+    """
+    m = min(m, k)
+    mask = np.uint64((1 << (2 * m)) - 1)
+    minimizer = np.full(len(codes), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for shift in range(0, 2 * (k - m) + 1, 2):
+        mmer_hash = ((codes >> np.uint64(shift)) & mask) * _HASH_MULTIPLIER
+        np.minimum(minimizer, mmer_hash, out=minimizer)
+    return ((minimizer >> np.uint64(32)) % np.uint64(n_shards)).astype(np.int64)
+
+
+def _count_chunk(reads, k, offset, n_shards):
+    codes = edge_codes(reads, k)
+    positions = np.arange(offset, offset + len(codes), dtype=np.int64)
+    shards = minimizer_shards(codes, k, n_shards)
+    # arcs belong to the shard of their first k-mer
+    arcs = np.stack([codes[0::2], codes[1::2]], axis=1)
+    arc_shards = shards[0::2]
+
+    tables = []
+    for shard in range(n_shards):
+        in_shard = shards == shard
+        kmers, first, counts = np.unique(codes[in_shard], return_index=True, return_counts=True)
+        tables.append((kmers, counts, positions[in_shard][first],
+                       np.unique(arcs[arc_shards == shard], axis=0)))
+    return tables
+
+
+def _merge_shard(tables):
+    kmers, inverse = np.unique(np.concatenate([table[0] for table in tables]), return_inverse=True)
+    counts = np.zeros(len(kmers), dtype=np.int64)
+    np.add.at(counts, inverse, np.concatenate([table[1] for table in tables]))
+    first = np.full(len(kmers), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first, inverse, np.concatenate([table[2] for table in tables]))
+    arcs = np.unique(np.concatenate([table[3] for table in tables]), axis=0)
+    return kmers, counts, first, arcs
+
+
+def count_parallel(data_list, k, workers, batch_reads=BATCH_READS):
+    """
+    Count k-mers and arcs in worker processes, partitioned by minimizer
+
+    Read batches are encoded in parallel and split into one shard per worker;
+    every merge task then merges the tables of one shard, so no two workers
+    count the same k-mer. Chunk tables wait until they hold as many k-mers as
+    the merged tables, so the merge work grows with the k-mers counted, not
+    with rounds times distinct k-mers.
+
+    Args:
+        data_list: Lists of reads, as passed to DBG
+        k: k-mer length (at most 32)
+        workers: Number of worker processes
+        batch_reads: Reads per encoding task
+
+    Returns:
+        (kmers, counts, arc_src, arc_dst): distinct k-mers in order of first
+        occurrence with their counts, and the distinct arcs as k-mer code pairs
+    """
+    def tasks():
+        offset = 0
+        for data in data_list:
+            for reads in iter_batches(data, batch_reads):
+                yield reads, k, offset, workers
+                offset += 4 * sum(max(len(read) - k - 1, 0) for read in reads)
+
+    # per shard: the merged table so far and the chunk tables waiting to join it
+    shard_tables = [None] * workers
+    pending = [[] for _ in range(workers)]
+    n_pending = 0
+
+    def merge(pool):
+        return pool.map(_merge_shard, [([table] if table is not None else []) + tables
+                                       for table, tables in zip(shard_tables, pending)])
+
+    with worker_pool(workers) as pool:
+        for tables in map_rounds(pool, _count_chunk, tasks(), workers):
+            for shard, table in enumerate(tables):
+                pending[shard].append(table)
+                n_pending += len(table[0])
+            # merging costs the size of the tables, so wait until as much is pending
+            if n_pending > sum(len(table[0]) for table in shard_tables if table is not None):
+                shard_tables = merge(pool)
+                pending, n_pending = [[] for _ in range(workers)], 0
+        if any(pending):
+            shard_tables = merge(pool)
+
+    if shard_tables[0] is None:
+        empty = np.zeros(0, dtype=np.uint64)
+        return empty, np.zeros(0, dtype=np.int64), empty, empty
+    kmers = np.concatenate([table[0] for table in shard_tables])
+    counts = np.concatenate([table[1] for table in shard_tables])
+    first = np.concatenate([table[2] for table in shard_tables])
+    arcs = np.concatenate([table[3] for table in shard_tables])
+    order = np.argsort(first)
+    return kmers[order], counts[order], arcs[:, 0], arcs[:, 1]
+
+
+class BloomFilter:
+    """
+    Bit array remembering which packed k-mers have been seen, with false positives
+
+    Args:
+        n_bits: Size of the bit array, rounded up to a power of two
+        n_hashes: Number of bits set per k-mer (at most 3)
+    """
+    def __init__(self, n_bits=BLOOM_BITS, n_hashes=3):
+        self.log_bits = max(int(n_bits - 1).bit_length(), 3)
+        self.n_hashes = n_hashes
+        self._bits = np.zeros(1 << (self.log_bits - 3), dtype=np.uint8)
+
+    def _positions(self, codes):
+        for multiplier in _BLOOM_MULTIPLIERS[:self.n_hashes]:
+            h = codes * _HASH_MULTIPLIER
+            h ^= h >> np.uint64(31)
+            h *= np.uint64(multiplier)
+            yield h >> np.uint64(64 - self.log_bits)
+
+    def add(self, codes):
+        """
+        Insert codes; returns which of them were (probably) present before the call
+        """
+        codes = np.asarray(codes, dtype=np.uint64)
+        present = np.ones(len(codes), dtype=bool)
+        for pos in self._positions(codes):
+            byte, mask = pos >> np.uint64(3), np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8)
+            present &= (self._bits[byte] & mask) != 0
+            np.bitwise_or.at(self._bits, byte, mask)
+        return present
+
+
+def repeated_kmers(data_list, k, n_bits=BLOOM_BITS, batch_reads=BATCH_READS):
+    """
+    First pass of a solid k-mer build: k-mers occurring at least twice
+
+    Every occurrence is checked against a Bloom filter, so k-mers seen only once
+    (mostly sequencing errors) are never stored. False positives of the filter may
+    let a few of them through; exact counts in the second pass remove those.
+
+    Args:
+        data_list: Re-iterable collections of reads, as passed to DBG
+        k: k-mer length (at most 32)
+        n_bits: Size of the Bloom filter in bits
+        batch_reads: Reads encoded at a time
+
+    Returns:
+        Sorted uint64 array of the distinct repeated k-mers
+    """
+    bloom = BloomFilter(n_bits)
+    repeated = np.zeros(0, dtype=np.uint64)
+    pending = []
+    n_pending = 0
+    for data in data_list:
+        for reads in iter_batches(data, batch_reads):
+            kmers, counts = np.unique(window_codes(reads, k), return_counts=True)
+            seen = bloom.add(kmers)
+            pending.append(kmers[seen | (counts > 1)])
+            n_pending += len(pending[-1])
+            # merging costs the size of the table, so wait until as much is pending
+            if n_pending > len(repeated):
+                repeated = np.unique(np.concatenate([repeated] + pending))
+                pending, n_pending = [], 0
+    return np.unique(np.concatenate([repeated] + pending))
+
+
+def solid_kmers(data_list, k, min_count, n_bits=BLOOM_BITS, batch_reads=BATCH_READS):
+    """
+    K-mers occurring at least min_count times (min_count >= 2)
+
+    The k-mers passing the Bloom filter of repeated_kmers are counted exactly in
+    a second pass over the reads.
+
+    Args:
+        data_list: Re-iterable collections of reads, as passed to DBG
+        k: k-mer length (at most 32)
+        min_count: Abundance threshold
+        n_bits: Size of the Bloom filter in bits
+        batch_reads: Reads encoded at a time
+
+    Returns:
+        Sorted uint64 array of the solid k-mers
+    """
+    repeated = repeated_kmers(data_list, k, n_bits, batch_reads)
+    counts = np.zeros(len(repeated), dtype=np.int64)
+    for data in data_list:
+        for reads in iter_batches(data, batch_reads):
+            pos, found = find_sorted(repeated, window_codes(reads, k))
+            counts += np.bincount(pos[found], minlength=len(repeated))
+    return repeated[counts >= min_count]
+
+
+def _hash_prefix(codes, bits, skip=0):
+    # `bits` bits of the k-mer hash, after its first `skip` bits
+    h = (codes * _HASH_MULTIPLIER) << np.uint64(skip)
+    return (h >> np.uint64(64 - bits)).astype(np.int64)
+
+
+def _spill(paths, buckets, records):
+    # append the records to the files of their buckets, keeping their order
+    order = np.argsort(buckets, kind='stable')
+    ends = np.cumsum(np.bincount(buckets, minlength=len(paths))).tolist()
+    records = records[order]
+    start = 0
+    for path, end in zip(paths, ends):
+        if end > start:
+            with open(path, 'ab') as f:
+                records[start: end].tofile(f)
+        start = end
+
+
+def _read_chunks(path, dtype, chunk_bytes):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = np.fromfile(f, dtype=dtype, count=max(chunk_bytes // dtype.itemsize, 1))
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+def _count_bucket(prefix, bits, budget):
+    # count the bucket in prefix.kmers and prefix.arcs, splitting it by further
+    # hash bits while it would not fit in the budget (unique needs about 3x the file)
+    kmer_path, arc_path = prefix + '.kmers', prefix + '.arcs'
+    if not os.path.exists(kmer_path):
+        return []
+    if 4 * os.path.getsize(kmer_path) > budget and bits + SPLIT_BITS <= 64:
+        subs = [f"{prefix}_{bucket:x}" for bucket in range(1 << SPLIT_BITS)]
+        for path, dtype, key in ((kmer_path, _OCCURRENCE, 'code'), (arc_path, _ARC, 'src')):
+            if os.path.exists(path):
+                for chunk in _read_chunks(path, dtype, budget // 4):
+                    _spill([sub + path[len(prefix):] for sub in subs],
+                           _hash_prefix(chunk[key], SPLIT_BITS, bits), chunk)
+                os.remove(path)
+        return [table for sub in subs for table in _count_bucket(sub, bits + SPLIT_BITS, budget)]
+
+    occurrences = np.fromfile(kmer_path, dtype=_OCCURRENCE)
+    # occurrences are stored in stream order, so the first index is the first occurrence
+    kmers, first, counts = np.unique(occurrences['code'], return_index=True, return_counts=True)
+    first = occurrences['position'][first]
+    del occurrences
+    arcs = np.unique(np.fromfile(arc_path, dtype=_ARC)) if os.path.exists(arc_path) \
+        else np.zeros(0, dtype=_ARC)
+    for path in (kmer_path, arc_path):
+        if os.path.exists(path):
+            os.remove(path)
+    return [(kmers, counts, first, np.stack([arcs['src'], arcs['dst']], axis=1))]
+
+
+def count_external(data_list, k, memory_mb, tmp_dir=None, batch_reads=BATCH_READS, solid=None):
+    """
+    Count k-mers and arcs out of core, in bucket files on disk
+
+    Reads are encoded in batches of at most a quarter of the memory budget, and
+    occurrences are buffered up to another quarter before they are appended to
+    one file per hash prefix. Each bucket is counted on its own and split by
+    further hash bits when it does not fit in the budget. Only the distinct k-mers
+    and arcs, which the graph needs anyway, are ever held in memory together.
+
+    Args:
+        data_list: Collections of reads, as passed to DBG
+        k: k-mer length (at most 32)
+        memory_mb: Memory budget of the counting in MiB
+        tmp_dir: Directory for the bucket files (default: the system temporary directory)
+        batch_reads: Reads encoded at a time
+        solid: Sorted uint64 array; only arcs between these k-mers are counted
+
+    Returns:
+        (kmers, counts, arc_src, arc_dst), as returned by count_parallel
+    """
+    budget = int(memory_mb * (1 << 20))
+    with tempfile.TemporaryDirectory(prefix='kmers_', dir=tmp_dir) as directory:
+        prefixes = [os.path.join(directory, f"{bucket:02x}") for bucket in range(1 << SPILL_BITS)]
+
+        def flush(buffer):
+            occurrences = np.concatenate([part[0] for part in buffer])
+            _spill([prefix + '.kmers' for prefix in prefixes],
+                   _hash_prefix(occurrences['code'], SPILL_BITS), occurrences)
+            arcs = np.concatenate([part[1] for part in buffer])
+            _spill([prefix + '.arcs' for prefix in prefixes],
+                   _hash_prefix(arcs['src'], SPILL_BITS), arcs)
+
+        buffer = []
+        buffered = 0
+        offset = 0
+        for data in data_list:
+            for reads in iter_batches(data, batch_reads, budget // (4 * _BYTES_PER_BASE)):
+                codes = edge_codes(reads, k)
+                if solid is not None:
+                    in_solid = find_sorted(solid, codes)[1].reshape(-1, 2).all(axis=1)
+                    codes = codes.reshape(-1, 2)[in_solid].reshape(-1)
+                occurrences = np.empty(len(codes), dtype=_OCCURRENCE)
+                occurrences['code'] = codes
+                occurrences['position'] = np.arange(offset, offset + len(codes))
+                offset += len(codes)
+                arcs = np.empty(len(codes) // 2, dtype=_ARC)
+                arcs['src'], arcs['dst'] = codes[0::2], codes[1::2]
+                buffer.append((occurrences, arcs))
+                buffered += occurrences.nbytes + arcs.nbytes
+                if 4 * buffered > budget:
+                    flush(buffer)
+                    buffer, buffered = [], 0
+        if buffer:
+            flush(buffer)
+        del buffer
+        tables = [table for prefix in prefixes for table in _count_bucket(prefix, SPILL_BITS, budget)]
+
+    if not tables:
+        empty = np.zeros(0, dtype=np.uint64)
+        return empty, np.zeros(0, dtype=np.int64), empty, empty
+    kmers = np.concatenate([table[0] for table in tables])
+    counts = np.concatenate([table[1] for table in tables])
+    first = np.concatenate([table[2] for table in tables])
+    arcs = np.concatenate([table[3] for table in tables])
+    order = np.argsort(first)
+    return kmers[order], counts[order], arcs[:, 0], arcs[:, 1]
@@ -1,30 +1,45 @@
-from dbg import DBG
-from utils import read_data, calculate_n50
+from contig_coverage import contig_coverage
+from sweep import assemble, sweep_k
+from utils import read_data, calculate_assembly_stats, calculate_n50
+import logging
 import sys
 import os
 import time
 
-sys.setrecursionlimit(1000000)
+import numpy as np
 
 if __name__ == "__main__":
     # Start timing
     start_time = time.time()
+    # progress of the graph passes goes to stderr
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     
     argv = sys.argv
+    n_contigs = int(argv[2]) if len(argv) > 2 else 20
+    # several comma-separated k values sweep them in parallel and keep the best assembly
+    ks = [int(k) for k in argv[3].split(',')] if len(argv) > 3 else [25]
+    # a single-k graph is reloaded from this snapshot directory when it exists
+    snapshot = argv[4] if len(argv) > 4 else None
+    if snapshot is not None and len(ks) > 1:
+        sys.exit("A snapshot holds the graph of a single k; it cannot be used with a k sweep")
+
+    # reads are streamed from a dataset directory or straight from its .zip archive
+    dataset = argv[1][:-len('.zip')] if argv[1].endswith('.zip') else argv[1]
+    os.makedirs(os.path.join('./', dataset), exist_ok=True)
     short1, short2, long1 = read_data(os.path.join('./', argv[1]))
+    workers = os.cpu_count() or 1
+    n50_by_k = {}
+    if len(ks) == 1:
+        k = ks[0]
+        contigs, spectrum = assemble(k, [short1, short2, long1], n_contigs, snapshot,
+                                     simplify=True, workers=workers if k <= 32 else 1)
+    else:
+        k, contigs_by_k, n50_by_k, spectra = sweep_k([short1, short2, long1], ks, n_contigs,
+                                                     workers, simplify=True)
+        contigs, spectrum = contigs_by_k[k], spectra[k]
     
-    k = 25
-    dbg = DBG(k=k, data_list=[short1, short2, long1])
-    
-    # Store contigs for N50 calculation
-    contigs = []
-    
-    with open(os.path.join('./', argv[1], 'contig.fasta'), 'w') as f:
-        for i in range(20):
-            c = dbg.get_longest_contig()
-            if c is None:
-                break
-            contigs.append(c)
+    with open(os.path.join('./', dataset, 'contig.fasta'), 'w') as f:
+        for i, c in enumerate(contigs):
             # redirect print to file instead of console
             print(f">contig_{i}\n{c}", file=f)
     
@@ -34,15 +49,43 @@ if __name__ == "__main__":
     
     # Calculate N50
     n50 = calculate_n50(contigs)
+    stats = calculate_assembly_stats(contigs)
     
     # Write statistics to file
-    stats_file = os.path.join('./', argv[1], 'assembly_stats.txt')
+    stats_file = os.path.join('./', dataset, 'assembly_stats.txt')
     with open(stats_file, 'w') as f:
         print("Assembly Statistics", file=f)
         print("===================", file=f)
         print(f"Total execution time: {total_time:.2f} seconds", file=f)
         print(f"Number of contigs: {len(contigs)}", file=f)
+        print(f"k: {k}", file=f)
+        if n50_by_k:
+            print(f"N50 by k: {n50_by_k}", file=f)
         print(f"N50: {n50}", file=f)
+        print(f"Total length: {stats['total_length']}", file=f)
         print(f"Contig lengths: {[len(c) for c in contigs]}", file=f)
+        print(f"k-mer coverage peak: {spectrum['peak']} (error valley at {spectrum['valley']})", file=f)
+        if len(spectrum['peaks']) > 1:
+            # several coverage levels, e.g. short and long reads: no single peak fits
+            print(f"Estimated genome size: {spectrum['genome_size']} "
+                  f"(unreliable, spectrum peaks at {spectrum['peaks']})", file=f)
+        else:
+            print(f"Estimated genome size: {spectrum['genome_size']}", file=f)
+        print(f"Estimated error rate: {spectrum['error_rate']:.4f}", file=f)
+    
+    # number of k-mers by occurrences
+    with open(os.path.join('./', dataset, 'kmer_histogram.txt'), 'w') as f:
+        for occurrences, n_kmers in enumerate(spectrum['histogram']):
+            if n_kmers:
+                print(f"{occurrences}\t{n_kmers}", file=f)
+    
+    # read support of the contigs, computed after the timed assembly
+    mean_coverage, depths = contig_coverage(contigs, [short1, short2, long1], min(k, 32), workers)
+    with open(os.path.join('./', dataset, 'contig_coverage.tsv'), 'w') as f:
+        print("contig\tlength\tmean_coverage", file=f)
+        for i, (c, coverage) in enumerate(zip(contigs, mean_coverage)):
+            print(f"contig_{i}\t{len(c)}\t{coverage:.2f}", file=f)
+    np.savez_compressed(os.path.join('./', dataset, 'contig_depth.npz'),
+                        **{f"contig_{i}": depth.astype(np.int32) for i, depth in enumerate(depths)})
     
-    print(f"{argv[1]}  python  {total_time:.2f}  {n50}")
\ No newline at end of file
+    print(f"{dataset}  python  {total_time:.2f}  {n50}")
\ No newline at end of file
@@ -0,0 +1,92 @@
+import logging
+import os
+
+from correct import correct_data
+from dbg import DBG, graph_options
+from utils import calculate_kmer_spectrum, calculate_n50, shared_object, worker_pool
+
+logger = logging.getLogger(__name__)
+
+
+def assemble(k, data_list, n_contigs=20, snapshot=None, correct=False, **options):
+    """
+    Build the DBG for one k and extract its longest contigs
+
+    Args:
+        k: k-mer length; k <= 32 uses packed k-mers
+        data_list: Collections of reads, as passed to DBG
+        n_contigs: Maximum number of contigs
+        snapshot: Graph snapshot directory (see DBG.save, k <= 32); loaded
+            instead of building when it exists, written right after the build
+            otherwise. A snapshot built with other options is rejected
+        correct: Correct isolated substitutions in the reads against their k-mer
+            spectrum before the build (k <= 32, see correct.correct_data)
+        options: Further DBG arguments, e.g. simplify=True
+
+    Returns:
+        (contigs, spectrum): contigs, longest first, and the k-mer spectrum of the
+        graph from calculate_kmer_spectrum
+    """
+    correct = correct and k <= 32
+    build_options = dict(graph_options(**options), corrected=correct)
+    if snapshot is not None and k > 32:
+        raise ValueError("Snapshots require packed k-mers (k <= 32)")
+    if snapshot is not None and os.path.exists(snapshot):
+        dbg = DBG.load(snapshot)
+        if dbg.k != k:
+            raise ValueError(f"Snapshot {snapshot} holds a graph for k={dbg.k}, not k={k}")
+        if dict({'corrected': False}, **dbg.options) != build_options:
+            raise ValueError(f"Snapshot {snapshot} was built with {dbg.options}, not {build_options}")
+    else:
+        if correct:
+            data_list = correct_data(data_list, k, workers=options.get('workers', 1))
+        dbg = DBG(k=k, data_list=data_list, packed=k <= 32, **options)
+        if correct:
+            logger.info("k=%d: corrected %d bases", k, sum(data.n_corrected for data in data_list))
+        if snapshot is not None:
+            # the graph also depends on whether its reads were corrected
+            dbg.options['corrected'] = correct
+            dbg.save(snapshot)
+    spectrum = calculate_kmer_spectrum(dbg.counts, k)
+    # components are extracted in parallel by as many workers as counted the k-mers
+    return dbg.get_longest_contigs(n_contigs, options.get('workers', 1)), spectrum
+
+
+def _assemble_shared(k, n_contigs, options):
+    # the reads are shared with the sweep workers
+    return assemble(k, shared_object(), n_contigs, **options)
+
+
+def sweep_k(data_list, ks, n_contigs=20, workers=None, **options):
+    """
+    Assemble the same reads for several values of k in parallel
+
+    The reads are read once into memory and handed to the worker processes when
+    they start; each worker builds one graph at a time, so peak memory grows with
+    the number of workers.
+
+    Args:
+        data_list: Collections of reads, as passed to DBG
+        ks: k-mer lengths to try
+        n_contigs: Maximum number of contigs per k
+        workers: Number of worker processes (default: one per CPU, at most len(ks))
+        options: Further DBG arguments; graphs are built serially inside the workers
+
+    Returns:
+        (best_k, contigs, n50s, spectra): the k with the highest N50 (the first
+        listed on ties), and the contigs, N50 and k-mer spectrum of every k
+    """
+    data_list = [list(data) for data in data_list]
+    workers = min(len(ks), workers or os.cpu_count() or 1)
+    tasks = [(k, n_contigs, dict(options, workers=1)) for k in ks]
+    with worker_pool(workers, data_list) as pool:
+        results = dict(zip(ks, pool.starmap(_assemble_shared, tasks)))
+    contigs = {k: results[k][0] for k in ks}
+    spectra = {k: results[k][1] for k in ks}
+
+    n50s = {}
+    for k in ks:
+        n50s[k] = calculate_n50(contigs[k])
+        logger.info("k=%d  N50 %d  (%d contigs)", k, n50s[k], len(contigs[k]))
+    best_k = max(ks, key=n50s.get)
+    return best_k, contigs, n50s, spectra
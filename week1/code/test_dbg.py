@@ -0,0 +1,482 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import random
+import zipfile
+from itertools import product
+
+import numpy as np
+import pytest
+
+from benchmark import DATA_DIR, run_benchmarks, run_case
+from correct import correct_data
+from contig_coverage import contig_coverage
+from dbg import DBG, reverse_complement
+from kmer import PackedKmerIndex, decode_kmer, edge_codes, encode_kmer, iter_edges
+from kmer_count import BloomFilter, count_parallel
+from sweep import assemble, sweep_k
+from utils import calculate_kmer_spectrum, read_data, read_fasta
+
+
+def simulate_reads(genome, n, seed, error_rate=0.01, read_len=100):
+    # Reads at random positions with substitutions at error_rate (a quarter of
+    # which keep the base); returns the reads and their start positions
+    rng = random.Random(seed)
+    reads, starts = [], []
+    for _ in range(n):
+        start = rng.randrange(len(genome) - read_len)
+        read = [rng.choice('ACGT') if rng.random() < error_rate else base
+                for base in genome[start: start + read_len]]
+        reads.append(''.join(read))
+        starts.append(start)
+    return reads, starts
+
+
+@pytest.fixture
+def genome():
+    rng = random.Random(0)
+    return ''.join(rng.choice('ACGT') for _ in range(3000))
+
+
+@pytest.fixture
+def reads(genome):
+    # Error-free reads of length 100 tiling the genome with a step of 7
+    return [genome[i: i + 100] for i in range(0, len(genome) - 100, 7)]
+
+
+@pytest.fixture
+def noisy_reads(genome):
+    # Reads at random positions with 1% substitution errors
+    return simulate_reads(genome, 400, seed=1)[0]
+
+
+@pytest.fixture
+def repeat_reads():
+    # Noisy reads of a genome with tandem copies of three 40 bp repeats, whose
+    # graph has cycles
+    rng = random.Random(2)
+    units = [''.join(rng.choice('ACGT') for _ in range(40)) for _ in range(3)]
+    genome = ''.join(''.join(rng.choice('ACGT') for _ in range(rng.randrange(30, 300)))
+                     + rng.choice(units) * rng.randrange(1, 4) for _ in range(30))
+    return simulate_reads(genome, 1500, seed=3)[0]
+
+
+def get_contigs(dbg, n=20):
+    contigs = []
+    for _ in range(n):
+        c = dbg.get_longest_contig()
+        if c is None:
+            break
+        contigs.append(c)
+    return contigs
+
+
+def assert_same_graph(a, b):
+    # same k-mers at the same indices, same counts and same children
+    assert len(a) == len(b)
+    assert np.array_equal(a.kmer2idx.code(np.arange(len(a))), b.kmer2idx.code(np.arange(len(b))))
+    assert np.array_equal(a.counts, b.counts)
+    for idx in range(len(a)):
+        assert a.get_children(idx) == b.get_children(idx)
+
+
+def test_encode_decode():
+    kmer = 'ACGTTGCAAGT'
+    assert decode_kmer(encode_kmer(kmer), len(kmer)) == kmer
+    assert decode_kmer(encode_kmer('T' * 32), 32) == 'T' * 32
+
+
+def test_edge_codes(reads):
+    """
+    Packed arc codes follow the order in which DBG._build adds arcs.
+    """
+    k = 15
+    codes = edge_codes(reads[:3], k)
+    expected = []
+    for read in reads[:3]:
+        rc = reverse_complement(read)
+        for i in range(len(read) - k - 1):
+            expected += [read[i: i + k], read[i + 1: i + 1 + k]]
+            expected += [rc[i: i + k], rc[i + 1: i + 1 + k]]
+    assert [decode_kmer(c, k) for c in codes] == expected
+
+
+def test_iter_edges(reads):
+    """
+    The streaming extractor yields the same arcs as the vectorized batch encoder.
+    """
+    for k in (15, 32):
+        streamed = [code for read in reads[:3] for arc in iter_edges(read, k) for code in arc]
+        assert streamed == edge_codes(reads[:3], k).tolist()
+    # codes are Python ints, so the streaming extractor is not limited to k <= 32
+    read = reads[0]
+    arcs = list(iter_edges(read, 41))
+    assert len(arcs) == 2 * (len(read) - 41 - 1)
+    assert decode_kmer(arcs[0][0], 41) == read[:41]
+    assert decode_kmer(arcs[1][0], 41) == reverse_complement(read)[:41]
+
+
+def test_packed_index():
+    index = PackedKmerIndex(4)
+    ids = index.add(np.array([9, 3, 9, 7], dtype=np.uint64))
+    assert ids.tolist() == [0, 1, 0, 2]
+    ids = index.add(np.array([1, 7, 3], dtype=np.uint64))
+    assert ids.tolist() == [3, 2, 1]
+    assert index.lookup(np.array([7, 8], dtype=np.uint64)).tolist() == [2, -1]
+    assert 9 in index and 8 not in index
+    with pytest.raises(ValueError):
+        PackedKmerIndex(33)
+
+
+def test_packed_contigs(reads):
+    """
+    Packed mode must assemble exactly the contigs of the string mode.
+    """
+    contigs = get_contigs(DBG(k=25, data_list=[reads]))
+    packed_contigs = get_contigs(DBG(k=25, data_list=[reads], packed=True))
+    assert packed_contigs == contigs
+    assert len(contigs[0]) > 1000
+
+
+def test_incremental_depths(noisy_reads, repeat_reads):
+    """
+    Reusing depths across contigs gives the contigs of a full recomputation,
+    also where depths were cut at cycles and on compacted and simplified graphs.
+    """
+    for reads, options in product([noisy_reads, repeat_reads], ({}, {'compact': True}, {'simplify': True})):
+        dbg = DBG(k=25, data_list=[reads], packed=True, **options)
+        full = DBG(k=25, data_list=[reads], packed=True, **options)
+        for _ in range(30):
+            full._reset()
+            assert dbg.get_longest_contig() == full.get_longest_contig()
+
+
+def test_children_order(noisy_reads):
+    """
+    Children are stored highest count first, then lowest index, and stay so after compaction.
+    """
+    for compact in (False, True):
+        dbg = DBG(k=25, data_list=[noisy_reads], packed=True, compact=compact)
+        for idx in np.flatnonzero(dbg.alive).tolist():
+            children = dbg.get_children(idx)
+            assert children == sorted(children, key=lambda child: (-dbg.counts[child], child))
+
+
+def test_compaction(noisy_reads):
+    """
+    Unitig compaction shrinks the graph without changing the contigs.
+    """
+    dbg = DBG(k=25, data_list=[noisy_reads], packed=True)
+    compacted = DBG(k=25, data_list=[noisy_reads], packed=True, compact=True)
+    assert len(compacted) < len(dbg) / 10
+    assert compacted.coverage[compacted.alive].sum() == dbg.counts.sum()
+    assert compacted.lengths[compacted.alive].sum() == len(dbg)
+    assert get_contigs(compacted, 30) == get_contigs(dbg, 30)
+
+
+def test_simplify(caplog, genome, noisy_reads):
+    """
+    Tip clipping and bubble popping remove error branches but keep the genome path.
+    """
+    compacted = DBG(k=25, data_list=[noisy_reads], packed=True, compact=True)
+    with caplog.at_level(logging.INFO, logger='dbg'):
+        simplified = DBG(k=25, data_list=[noisy_reads], packed=True, simplify=True)
+    assert "Clipped 297 tips" in caplog.text and "Popped 13 bubble branches" in caplog.text
+    assert len(simplified) < len(compacted) * 0.6
+    assert simplified.lengths[simplified.alive].sum() < compacted.lengths[compacted.alive].sum()
+    contigs = get_contigs(simplified, 2)
+    assert contigs == get_contigs(compacted, 2)
+    assert contigs[0] in genome or contigs[0] in reverse_complement(genome)
+
+
+def test_snapshot(tmp_path, noisy_reads):
+    """
+    A saved graph loads memory-mapped and yields the contigs of the graph it was saved from.
+    """
+    dbg = DBG(k=25, data_list=[noisy_reads], packed=True, simplify=True)
+    dbg.save(tmp_path / "graph")
+    loaded = DBG.load(tmp_path / "graph")
+    assert isinstance(loaded._children, np.memmap)
+    assert loaded._suffixes == dbg._suffixes
+    assert loaded.options == dbg.options == {'compact': True, 'min_count': 1, 'simplify': True}
+    contigs = get_contigs(dbg)
+    assert get_contigs(loaded) == contigs
+    # traversal only changes the in-memory copy
+    assert get_contigs(DBG.load(tmp_path / "graph", mmap=False)) == contigs
+    with pytest.raises(ValueError):
+        DBG(k=25, data_list=[noisy_reads]).save(tmp_path / "strings")
+
+    # assemble reuses a snapshot only for the options it was built with
+    result = assemble(25, [noisy_reads], 5, snapshot=tmp_path / "assembly", simplify=True)
+    assert assemble(25, [], 5, snapshot=tmp_path / "assembly", simplify=True) == result
+    for options in ({}, {'simplify': True, 'min_count': 2}, {'simplify': True, 'correct': True}):
+        with pytest.raises(ValueError, match="built with"):
+            assemble(25, [], 5, snapshot=tmp_path / "assembly", **options)
+    with pytest.raises(ValueError, match="packed"):
+        assemble(41, [], 5, snapshot=tmp_path / "long")
+
+
+def test_component_extraction(genome, noisy_reads, repeat_reads):
+    """
+    Per-component extraction in worker processes returns the contigs of the serial loop.
+    """
+    # the reversed reads form a second genome whose paths tie with the first
+    data_list = [noisy_reads, [read[::-1] for read in noisy_reads]]
+    dbg = DBG(k=25, data_list=data_list, packed=True)
+    parallel = DBG(k=25, data_list=data_list, packed=True)
+    assert len(np.unique(parallel._components()[parallel.alive])) == 4
+    contigs = get_contigs(dbg, 40)
+    assert parallel.get_longest_contigs(40, workers=3) == contigs
+    # the emitted paths are gone, traversal continues on the rest of the graph
+    assert parallel.get_longest_contig() == dbg.get_longest_contig()
+
+    compacted = DBG(k=25, data_list=data_list, packed=True, simplify=True)
+    assert compacted.get_longest_contigs(40, workers=2) == \
+        DBG(k=25, data_list=data_list, packed=True, simplify=True).get_longest_contigs(40)
+    cyclic = DBG(k=25, data_list=[repeat_reads], packed=True)
+    assert cyclic.get_longest_contigs(40, workers=2) == \
+        get_contigs(DBG(k=25, data_list=[repeat_reads], packed=True), 40)
+
+
+def test_parallel_build(noisy_reads):
+    """
+    Minimizer-partitioned counting builds the same graph as the serial build.
+    """
+    data_list = [noisy_reads[:150], noisy_reads[150:]]
+    dbg = DBG(k=25, data_list=data_list, packed=True)
+    parallel = DBG(k=25, data_list=data_list, packed=True, workers=3)
+    assert_same_graph(parallel, dbg)
+    assert get_contigs(parallel) == get_contigs(dbg)
+    # small batches fold many rounds of chunk tables into the shard tables
+    for one_round, many_rounds in zip(count_parallel(data_list, 25, 3),
+                                      count_parallel(data_list, 25, 3, batch_reads=16)):
+        assert np.array_equal(one_round, many_rounds)
+    with pytest.raises(ValueError):
+        DBG(k=25, data_list=data_list, workers=2)
+
+
+def test_external_build(tmp_path, noisy_reads):
+    """
+    Out-of-core counting builds the serial graph, also when buckets must be split.
+    """
+    data_list = [noisy_reads[:150], noisy_reads[150:]]
+    dbg = DBG(k=25, data_list=data_list, packed=True)
+    # 0.01 MiB forces a spill per batch and splits every bucket once
+    external = DBG(k=25, data_list=data_list, packed=True, memory_mb=0.01, tmp_dir=tmp_path)
+    assert_same_graph(external, dbg)
+    assert list(tmp_path.iterdir()) == []
+    solid = DBG(k=25, data_list=data_list, packed=True, min_count=2)
+    external = DBG(k=25, data_list=data_list, packed=True, min_count=2, memory_mb=1)
+    assert_same_graph(external, solid)
+    assert get_contigs(external) == get_contigs(solid)
+
+
+def test_solid_kmers(noisy_reads):
+    """
+    Only k-mers occurring at least min_count times, and the arcs between them, enter the graph.
+    """
+    k, min_count = 25, 3
+    occurrences = {}
+    for read in noisy_reads:
+        for seq in (read, reverse_complement(read)):
+            for i in range(len(seq) - k):
+                occurrences[seq[i: i + k]] = occurrences.get(seq[i: i + k], 0) + 1
+    solid = set()
+    for read in noisy_reads:
+        for seq in (read, reverse_complement(read)):
+            for i in range(len(seq) - k - 1):
+                kmer1, kmer2 = seq[i: i + k], seq[i + 1: i + 1 + k]
+                if occurrences[kmer1] >= min_count and occurrences[kmer2] >= min_count:
+                    solid |= {kmer1, kmer2}
+
+    dbg = DBG(k=k, data_list=[noisy_reads], packed=True)
+    filtered = DBG(k=k, data_list=[noisy_reads], packed=True, min_count=min_count)
+    assert {filtered.kmer2idx.kmer(idx) for idx in range(len(filtered))} == solid
+    assert len(filtered) < len(dbg) / 2
+    # false positives of a tiny Bloom filter cost memory, not accuracy
+    chunks = [noisy_reads[i: i + 50] for i in range(0, len(noisy_reads), 50)]
+    tiny = DBG(k=k, data_list=chunks, packed=True, min_count=min_count, bloom_bits=1 << 10)
+    assert np.array_equal(tiny.kmer2idx.code(np.arange(len(tiny))),
+                          filtered.kmer2idx.code(np.arange(len(filtered))))
+    assert np.array_equal(tiny.counts, filtered.counts)
+    contigs = get_contigs(filtered)
+    assert get_contigs(tiny) == contigs
+    assert len(contigs[0]) > 1000
+
+    bloom = BloomFilter(1 << 16)
+    assert bloom.add(np.array([5, 9, 5], dtype=np.uint64)).tolist() == [False, False, False]
+    assert bloom.add(np.array([9, 7], dtype=np.uint64)).tolist() == [True, False]
+    with pytest.raises(ValueError):
+        DBG(k=k, data_list=[noisy_reads], min_count=2)
+
+
+def test_sweep_k(noisy_reads):
+    """
+    A multi-k sweep assembles every k as a single run would and keeps the best N50.
+    """
+    best_k, contigs, n50s, spectra = sweep_k([iter(noisy_reads)], [21, 25, 41], n_contigs=5,
+                                             workers=2, simplify=True)
+    assert sorted(n50s) == [21, 25, 41]
+    assert n50s[best_k] == max(n50s.values())
+    assert (contigs[25], spectra[25]) == assemble(25, [noisy_reads], 5, simplify=True)
+    assert contigs[41] == assemble(41, [noisy_reads], 5, simplify=True)[0]
+
+
+def test_kmer_spectrum(genome):
+    """
+    The spectrum separates error k-mers from genome k-mers and recovers the simulation.
+    """
+    # 40x coverage with 1% substitutions, a quarter of which keep the base
+    reads = simulate_reads(genome, 1200, seed=2)[0]
+    dbg = DBG(k=25, data_list=[reads], packed=True)
+    spectrum = calculate_kmer_spectrum(dbg.counts, 25)
+    assert sum(spectrum['histogram']) == len(dbg)
+    assert spectrum['valley'] < 5 and 20 <= spectrum['peak'] <= 30
+    assert spectrum['peaks'] == [spectrum['peak']]
+    assert abs(spectrum['genome_size'] - len(genome)) < 0.1 * len(genome)
+    assert 0.005 < spectrum['error_rate'] < 0.01
+    assert calculate_kmer_spectrum(np.zeros(0), 25)['genome_size'] == 0
+
+
+def test_mixed_kmer_spectrum(genome):
+    """
+    A taller low-coverage hump of long-read k-mers does not pass for the genome peak,
+    and the spectrum reports both peaks.
+    """
+    # 30x short reads of the genome, 6x long reads of the genome and of twice as
+    # much sequence only they cover
+    rng = random.Random(4)
+    extra = ''.join(rng.choice('ACGT') for _ in range(2 * len(genome)))
+    short = simulate_reads(genome, 900, seed=5)[0]
+    long = simulate_reads(genome + extra, 54, seed=6, read_len=1000)[0]
+    dbg = DBG(k=25, data_list=[short, long], packed=True)
+    spectrum = calculate_kmer_spectrum(dbg.counts, 25)
+    histogram = np.array(spectrum['histogram'])
+    low = spectrum['valley'] + int(np.argmax(histogram[spectrum['valley']:]))
+    assert low < 10 < spectrum['peak']
+    assert len(spectrum['peaks']) == 2 and spectrum['peaks'][0] < 10 < spectrum['peaks'][1]
+    assert abs(spectrum['genome_size'] - len(genome)) < 0.5 * len(genome)
+
+
+def test_read_correction(genome):
+    """
+    Spectrum-based correction removes most substitutions, never adds any, and shrinks the graph.
+    """
+    reads, starts = simulate_reads(genome, 1200, seed=3)
+
+    def errors(read, start):
+        return sum(a != b for a, b in zip(read, genome[start: start + 100]))
+
+    corrected = correct_data([reads[:600], reads[600:]], 25)
+    fixed = list(corrected[0]) + list(corrected[1])
+    assert corrected[0].n_corrected + corrected[1].n_corrected > 0
+    assert all(errors(new, s) <= errors(old, s) for old, new, s in zip(reads, fixed, starts))
+    assert sum(map(errors, fixed, starts)) < 0.5 * sum(map(errors, reads, starts))
+    assert len(DBG(k=25, data_list=corrected, packed=True)) < 0.6 * len(DBG(k=25, data_list=[reads], packed=True))
+    parallel = correct_data([reads], 25, workers=2)[0]
+    parallel.batch_reads = 100
+    assert list(parallel) == fixed
+    contig = assemble(25, [reads], 1, correct=True, simplify=True)[0][0]
+    assert contig in genome or reverse_complement(contig) in genome
+
+
+def test_contig_coverage(genome, reads):
+    """
+    Reads from both strands are placed on the contigs that contain them, clipped at contig ends.
+    """
+    contigs = [genome[:1000], reverse_complement(genome[1000:2500]), 'ACGT' * 3, genome[:1000]]
+    # a read counts on a contig when they share at least one k-mer
+    expected = [np.zeros(1000, dtype=np.int64), np.zeros(1500, dtype=np.int64)]
+    for i in range(0, len(genome) - 100, 7):
+        for depth, (start, end) in zip(expected, ((0, 1000), (1000, 2500))):
+            if min(end, i + 100) - max(start, i) >= 25:
+                depth[max(start, i) - start: min(end, i + 100) - start] += 1
+    data_list = [reads[::2], [reverse_complement(read) for read in reads[1::2]]]
+    for workers in (1, 2):
+        mean_coverage, depths = contig_coverage(contigs, data_list, 25, workers=workers, batch_reads=50)
+        assert np.array_equal(depths[0], expected[0])
+        assert np.array_equal(depths[1], expected[1][::-1])
+        assert np.array_equal(depths[2], np.zeros(12))
+        assert np.array_equal(depths[3], expected[0])
+        assert mean_coverage[1] == pytest.approx(expected[1].mean())
+
+
+def test_read_fasta(tmp_path, reads):
+    """
+    Records spanning several lines are joined; gzip and zip inputs are read in place.
+    """
+    records = ''.join(f">read_{i}\n{read[:60]}\n{read[60:]}\n" for i, read in enumerate(reads))
+    (tmp_path / "long.fasta").write_text(records)
+    assert list(read_fasta(tmp_path, "long.fasta")) == reads
+
+    with gzip.open(tmp_path / "short_1.fasta.gz", "wt") as f:
+        f.write(records)
+    assert list(read_fasta(tmp_path, "short_1.fasta")) == reads
+
+    with zipfile.ZipFile(tmp_path / "data.zip", "w") as archive:
+        for name in ("short_1.fasta", "short_2.fasta", "long.fasta"):
+            archive.writestr(f"data/{name}", records)
+    short1, short2, long1 = read_data(str(tmp_path / "data.zip"))
+    assert list(short2) == reads
+
+    # the graph can be built straight from the streams
+    packed = DBG(k=25, data_list=[short1, long1], packed=True)
+    assert get_contigs(packed) == get_contigs(DBG(k=25, data_list=[reads, reads]))
+
+
+def test_benchmark():
+    """
+    The benchmark times every phase of a synthetic assembly and reports JSON-ready results.
+    """
+    result = run_case("synthetic", 3000, n_contigs=3, simplify=True)
+    assert list(result['phases']) == ['read', 'build', 'traverse', 'concat', 'write']
+    assert result['nodes'] > 0 and result['edges_per_second'] > 0
+    assert result['n50'] > 2000
+    assert json.loads(json.dumps(result)) == result
+
+    # cases run in their own processes, which may start counting workers
+    results = run_benchmarks([("synthetic", 3000)], n_contigs=3, simplify=True, workers=2)
+    assert [case['n50'] for case in results['cases']] == [result['n50']]
+    assert json.loads(json.dumps(results)) == results
+
+
+# contigs of the plain 20-contig loop on the course datasets, raw and simplified:
+# (lengths, sha256 of the newline-joined contigs)
+PINNED_CONTIGS = {
+    ('data1', False): ([15650, 9997, 9997, 9990, 9990, 9956, 9956, 4615, 3277, 828,
+                        684, 669, 669, 666, 666, 655, 654, 639, 639, 636],
+                       'ac9c66cd5219d23f581d050573eb67a4a2a838bd5a5eb6647f4f42de336ce492'),
+    ('data1', True): ([15650, 9997, 9997, 9990, 9956, 9956, 7157, 4615, 3277, 3245,
+                       828, 684, 669, 669, 666, 666, 655, 654, 639, 639],
+                      'a7aadb93854cc8ad2d7e96d3f35f4d477f3e4f4e47eefeb64622fd8591f21642'),
+    ('data2', False): ([15744, 10013, 10013, 9992, 9992, 9992, 5752, 5171, 4664, 3309,
+                        1009, 938, 829, 733, 654, 654, 652, 652, 652, 652],
+                       '8c61b4e040458ca2f5825e10937b4ec314b46650529cd803d03168c2b8b57c0e'),
+    ('data2', True): ([15744, 10013, 10013, 9992, 9992, 9992, 5752, 5171, 4664, 3309,
+                       1009, 938, 829, 733, 654, 654, 652, 652, 652, 652],
+                      '8c61b4e040458ca2f5825e10937b4ec314b46650529cd803d03168c2b8b57c0e'),
+    ('data3', False): ([9824, 9824, 9824, 9824, 9824, 9824, 9824, 9824, 3656, 3656,
+                        3592, 3592, 2604, 1848, 1517, 1352, 1239, 1239, 1239, 1239],
+                       '4a75c78635766af673696f28b8ef23d70992876dea9becb9ced45ac02d20c317'),
+    ('data3', True): ([9824, 9824, 9824, 9824, 9824, 9824, 9824, 9824, 3656, 3656,
+                       3592, 3592, 2604, 1848, 1517, 1352, 1239, 1239, 1239, 1239],
+                      '750f54d2cab1af8d9671a2690e538e98f2213904b3a8fc127456d69ad2db1cbc'),
+}
+
+
+@pytest.mark.parametrize(("dataset", "simplify"), sorted(PINNED_CONTIGS))
+def test_pinned_contigs(dataset, simplify):
+    """
+    The course datasets keep their contigs. These are not the contigs of the
+    original implementation: children with equal counts are visited lowest index
+    first instead of in Python set order (see DBG).
+    """
+    path = os.path.join(DATA_DIR, dataset + '.zip')
+    if not os.path.exists(path):
+        pytest.skip(f"{path} not found")
+    contigs = get_contigs(DBG(k=25, data_list=list(read_data(path)), packed=True, simplify=simplify))
+    lengths, digest = PINNED_CONTIGS[dataset, simplify]
+    assert [len(c) for c in contigs] == lengths
+    assert hashlib.sha256('\n'.join(contigs).encode('ascii')).hexdigest() == digest
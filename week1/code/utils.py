@@ -1,20 +1,155 @@
+import gzip
+import io
 import os
+import zipfile
+from itertools import islice
+from multiprocessing import Pool
+
+import numpy as np
+
+# reads per batch wherever reads are streamed: graph passes and worker tasks
+BATCH_READS = 4096
+# the k-mer spectrum is smoothed over this many occurrence counts to find its
+# peaks; a peak counts when it rises by this fraction of the highest one above
+# the dips separating it from higher peaks
+SPECTRUM_SMOOTHING = 5
+PEAK_PROMINENCE = 0.1
+
+# object shared with the workers of a worker_pool, set when each worker starts
+_shared = None
+
+
+def open_fasta(path, name):
+    """
+    Open a FASTA file for reading as text, wherever it is stored
+
+    Args:
+        path: Dataset directory or .zip archive
+        name: File name, e.g. "short_1.fasta"; inside a directory a gzipped
+            "short_1.fasta.gz" is used when the plain file does not exist
+
+    Returns:
+        Text stream; compressed data is decompressed while reading
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        for member in archive.namelist():
+            if os.path.basename(member) in (name, name + '.gz'):
+                stream = archive.open(member)
+                if member.endswith('.gz'):
+                    stream = gzip.open(stream)
+                return io.TextIOWrapper(stream, encoding='ascii')
+        raise FileNotFoundError(f"{name} not found in {path}")
+    file_path = os.path.join(path, name)
+    if not os.path.exists(file_path) and os.path.exists(file_path + '.gz'):
+        return gzip.open(file_path + '.gz', 'rt')
+    return open(file_path, 'r')
+
 
 def read_fasta(path, name):
-    data = []
-    with open(os.path.join(path, name), 'r') as f:
-        for line in f.readlines():
+    """
+    Stream the sequences of a FASTA file one record at a time
+
+    Args:
+        path: Dataset directory or .zip archive
+        name: File name
+
+    Yields:
+        Sequences, with the lines of multi-line records joined
+    """
+    with open_fasta(path, name) as f:
+        lines = []
+        for line in f:
             line = line.strip()
-            if line[0] != '>':
-                data.append(line)
-    return data
+            if not line:
+                continue
+            if line[0] == '>':
+                if lines:
+                    yield ''.join(lines)
+                lines = []
+            else:
+                lines.append(line)
+        if lines:
+            yield ''.join(lines)
+
+
+class FastaReads:
+    """
+    Reads of one FASTA file; every iteration streams the file again, so builds
+    that pass over the reads twice never hold them all in memory
+    """
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+    def __iter__(self):
+        return read_fasta(self.path, self.name)
+
 
 def read_data(path):
-    short1 = read_fasta(path, "short_1.fasta")
-    short2 = read_fasta(path, "short_2.fasta")
-    long1 = read_fasta(path, "long.fasta")
+    short1 = FastaReads(path, "short_1.fasta")
+    short2 = FastaReads(path, "short_2.fasta")
+    long1 = FastaReads(path, "long.fasta")
     return short1, short2, long1
 
+
+def iter_batches(data, size, max_bases=None):
+    """
+    Split reads into lists of at most size reads without materializing the whole input
+
+    With max_bases, a list also ends once its reads hold max_bases bases (it still
+    gets at least one read), which bounds the memory of batches of long reads.
+    """
+    data = iter(data)
+    if max_bases is None:
+        batch = list(islice(data, size))
+        while batch:
+            yield batch
+            batch = list(islice(data, size))
+        return
+    batch, bases = [], 0
+    for read in data:
+        batch.append(read)
+        bases += len(read)
+        if len(batch) == size or bases >= max_bases:
+            yield batch
+            batch, bases = [], 0
+    if batch:
+        yield batch
+
+
+def _init_shared(value):
+    global _shared
+    _shared = value
+
+
+def worker_pool(workers, shared=None):
+    """
+    Pool of worker processes that receive shared once, when each of them starts
+
+    Large read-only inputs (reads, a graph, an index) passed this way are not
+    pickled with every task; tasks get them back with shared_object().
+    """
+    return Pool(workers, initializer=_init_shared, initargs=(shared,))
+
+
+def shared_object():
+    """
+    Object passed to worker_pool, inside one of its workers
+    """
+    return _shared
+
+
+def map_rounds(pool, func, tasks, workers):
+    """
+    pool.starmap over an iterable of argument tuples, one round of workers tasks
+    at a time, so streamed reads are never all in memory; yields the results in
+    task order
+    """
+    for round_tasks in iter_batches(tasks, workers):
+        yield from pool.starmap(func, round_tasks)
+
+
 def calculate_n50(contigs):
     """
     Calculate N50 (length of the contig at which 50% of total assembly length is reached)
@@ -81,4 +216,77 @@ def calculate_assembly_stats(contigs):
         'mean_contig': total_length / len(contigs) if contigs else 0
     }
     
-    return stats
\ No newline at end of file
+    return stats
+
+def _spectrum_peaks(histogram, valley):
+    # local maxima of the smoothed histogram above the valley, with enough
+    # prominence: height over the higher of the lowest points between the peak
+    # and the next higher point (or the end) on either side. Each is reported at
+    # the highest count of the histogram within the smoothing window
+    smooth = np.convolve(histogram[valley:].astype(np.float64),
+                         np.ones(SPECTRUM_SMOOTHING) / SPECTRUM_SMOOTHING, mode='same')
+    if len(smooth) == 0:
+        return []
+    rises = np.concatenate([[True], smooth[1:] > smooth[:-1]])
+    falls = np.concatenate([smooth[:-1] >= smooth[1:], [True]])
+    peaks = []
+    for m in np.flatnonzero(rises & falls).tolist():
+        higher = np.flatnonzero(smooth > smooth[m])
+        left, right = higher[higher < m], higher[higher > m]
+        left_dip = smooth[left[-1] if len(left) else 0: m + 1].min()
+        right_dip = smooth[m: right[0] + 1 if len(right) else len(smooth)].min()
+        if smooth[m] - max(left_dip, right_dip) >= PEAK_PROMINENCE * smooth.max() or not len(higher):
+            start = valley + max(m - SPECTRUM_SMOOTHING // 2, 0)
+            peaks.append(start + int(np.argmax(histogram[start: valley + m + SPECTRUM_SMOOTHING // 2 + 1])))
+    return peaks
+
+
+def calculate_kmer_spectrum(counts, k):
+    """
+    k-mer spectrum of a DBG, with genome size and error rate estimated from it
+
+    DBG counts arc endpoints, so a k-mer gets two per occurrence inside a read;
+    the spectrum is over occurrences, (count + 1) // 2. Error k-mers form the
+    low-abundance part of the spectrum up to its first valley; the genome k-mers
+    form the peak after it. Both strands are in the graph, so the genome has half
+    as many k-mers as the solid part of the spectrum.
+
+    The peak is the hump holding the most k-mer occurrences (the maximum of the
+    occurrence-weighted histogram, moved uphill to the nearest maximum of the
+    histogram), not the tallest one: low-coverage k-mers, e.g. of long reads,
+    may form a taller hump of their own. When the spectrum has several peaks,
+    a single coverage does not describe it and the genome size is unreliable.
+
+    Args:
+        counts: Array of DBG k-mer counts
+        k: k-mer length
+
+    Returns:
+        Dictionary with the histogram (number of k-mers by occurrences), the valley
+        and peak occurrences, the occurrences of all peaks, the estimated genome
+        size and per-base error rate
+    """
+    occurrences = (np.asarray(counts, dtype=np.int64) + 1) // 2
+    histogram = np.bincount(occurrences[occurrences > 0])
+    if len(histogram) < 2:
+        return {'histogram': histogram.tolist(), 'valley': 0, 'peak': 0, 'peaks': [],
+                'genome_size': 0, 'error_rate': 0.0}
+    # first occurrence count after which the spectrum rises again
+    rising = np.flatnonzero(histogram[2:] > histogram[1:-1])
+    valley = int(rising[0]) + 1 if len(rising) else 1
+    weighted = histogram * np.arange(len(histogram))
+    peak = valley + int(np.argmax(weighted[valley:]))
+    while peak + 1 < len(histogram) and histogram[peak + 1] > histogram[peak]:
+        peak += 1
+    while peak > valley and histogram[peak - 1] > histogram[peak]:
+        peak -= 1
+    total, errors = weighted.sum(), weighted[:valley].sum()
+    return {
+        'histogram': histogram.tolist(),
+        'valley': valley,
+        'peak': peak,
+        'peaks': _spectrum_peaks(histogram, valley),
+        'genome_size': int(round((total - errors) / peak / 2)),
+        # a k-mer is error-free only when all k of its bases are
+        'error_rate': float(1 - (1 - errors / total) ** (1 / k)),
+    }
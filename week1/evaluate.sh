@@ -4,22 +4,15 @@ export PATH="${HOME}/.codon/bin:$PATH"
 # Enable strict error handling
 set -euo pipefail
 
-# Unzip all datasets
-unzip -o week1/data/data1.zip >/dev/null -d week1
-unzip -o week1/data/data2.zip >/dev/null -d week1
-unzip -o week1/data/data3.zip >/dev/null -d week1
-unzip -o week1/data/data4.zip >/dev/null -d week1
-
-# Set stack size limit
-ulimit -s 8192000 >/dev/null 2>&1
-
 # Print header
 echo "Dataset Language Runtime N50"
 echo "------------------------------"
 
 # Process each dataset
 for dataset in data1 data2 data3 data4; do
-    python3 week1/code/main.py week1/"$dataset"
+    # Python reads the archive in place; Codon needs the unzipped dataset
+    python3 week1/code/main.py week1/data/"$dataset".zip
+    unzip -o week1/data/"$dataset".zip >/dev/null -d week1/data
     codon build -release week1/code/main.codon -o main_codon_exe
-    ./main_codon_exe week1/"$dataset"
+    ./main_codon_exe week1/data/"$dataset"
 done
\ No newline at end of file
@@ -0,0 +1,94 @@
+# This source code is part of the Biotite package and is distributed
+# under the 3-Clause BSD License. Please see 'LICENSE.rst' for further
+# information.
+
+__all__ = [
+    "condensed_distances", "row_starts", "condensed_row", "set_condensed_row",
+    "condensed_submatrix"
+]
+
+import numpy as np
+
+
+def condensed_distances(distances):
+    """
+    Copy a distance matrix into a condensed single precision vector.
+
+    The condensed vector holds the upper triangle of the matrix row by
+    row, as returned by :func:`scipy.spatial.distance.pdist()`:
+    the distance between nodes `i < j` is at
+    ``row_starts(n)[i] + j - i - 1``.
+
+    Parameters
+    ----------
+    distances : ndarray, shape=(n,n) or shape=(n*(n-1)/2,)
+        A symmetric distance matrix or a condensed distance vector.
+
+    Returns
+    -------
+    condensed : ndarray, shape=(n*(n-1)/2,), dtype=np.float32
+        The condensed distances.
+    n : int
+        The number of nodes.
+    """
+    if distances.ndim == 1:
+        n = int(round((1 + np.sqrt(1 + 8 * len(distances))) / 2))
+        if n * (n - 1) // 2 != len(distances):
+            raise ValueError(
+                "Condensed distance vector must have length n*(n-1)/2"
+            )
+        return distances.astype(np.float32, copy=True), n
+
+    if distances.ndim != 2 or distances.shape[0] != distances.shape[1] \
+        or not np.allclose(distances.T, distances):
+            raise ValueError("Distance matrix must be symmetric")
+    n = distances.shape[0]
+    starts = row_starts(n)
+    condensed = np.empty(n * (n - 1) // 2, dtype=np.float32)
+    for i in range(n):
+        condensed[starts[i] : starts[i] + n - i - 1] = distances[i, i + 1:]
+    return condensed, n
+
+
+def row_starts(n):
+    """
+    Position of the distance between nodes `i` and `i+1` in a condensed
+    vector, for each node `i`.
+    """
+    i = np.arange(n, dtype=np.int64)
+    return i * n - i * (i + 1) // 2
+
+
+def condensed_row(condensed, starts, i, diagonal=np.inf):
+    """
+    All distances of node `i`, taken from a condensed vector.
+    """
+    n = len(starts)
+    row = np.empty(n, dtype=condensed.dtype)
+    row[:i] = condensed[starts[:i] + (i - 1 - np.arange(i))]
+    row[i] = diagonal
+    row[i + 1:] = condensed[starts[i] : starts[i] + n - i - 1]
+    return row
+
+
+def set_condensed_row(condensed, starts, i, row):
+    """
+    Set all distances of node `i` in a condensed vector; ``row[i]`` is
+    ignored.
+    """
+    n = len(starts)
+    condensed[starts[:i] + (i - 1 - np.arange(i))] = row[:i]
+    condensed[starts[i] : starts[i] + n - i - 1] = row[i + 1:]
+
+
+def condensed_submatrix(condensed, starts, keep):
+    """
+    Condensed vector of the distances between the nodes in `keep`,
+    in the order of `keep`.
+    """
+    sub_condensed = np.empty(len(keep) * (len(keep) - 1) // 2, dtype=condensed.dtype)
+    sub_starts = row_starts(len(keep))
+    for a, i in enumerate(keep[:-1]):
+        sub_condensed[sub_starts[a] : sub_starts[a] + len(keep) - a - 1] \
+            = condensed[starts[i] + keep[a + 1:] - i - 1]
+    return sub_condensed, sub_starts
@@ -7,92 +7,334 @@ __all__ = ["neighbor_joining"]
 
 import numpy as np
 from tree import Tree, TreeNode
+from distances import (
+    condensed_distances, row_starts, condensed_row, set_condensed_row,
+    condensed_submatrix
+)
 
 
 MAX_FLOAT = np.finfo(np.float32).max
+# Number of condensed distances corrected at once
+CHUNK_SIZE = 1 << 18
 
 
-def neighbor_joining(distances):
+def neighbor_joining(distances, algorithm="scan"):
+    """
+    Build an unrooted tree by neighbor joining.
+
+    `distances` is either a symmetric matrix or a condensed vector of
+    its upper triangle, as returned by
+    :func:`scipy.spatial.distance.pdist()`; the joining works on such a
+    condensed single precision copy in either case.
+    `algorithm` selects how the pair to join is found:
+    ``"scan"`` computes the whole corrected distance matrix on every
+    join, ``"rapid"`` searches rows of presorted distances and skips
+    pairs that cannot beat the current minimum (as in RapidNJ), which
+    visits only a small fraction of the matrix for large trees.
+    Both give the same tree.
+    """
     distances = np.asarray(distances)
     
-    if distances.shape[0] != distances.shape[1] or not np.allclose(distances.T, distances):
-        raise ValueError("Distance matrix must be symmetric")
     if np.isnan(distances).any():
         raise ValueError("Distance matrix contains NaN values")
     if (distances >= MAX_FLOAT).any():
         raise ValueError("Distance matrix contains infinity")
-    if distances.shape[0] < 4:
-        raise ValueError("At least 4 nodes are required")
     if (distances < 0).any():
         raise ValueError("Distances must be positive")
+    condensed, n = condensed_distances(distances)
+    if n < 4:
+        raise ValueError("At least 4 nodes are required")
+
+    if algorithm == "scan":
+        return _neighbor_joining_scan(condensed, n)
+    elif algorithm == "rapid":
+        return _neighbor_joining_rapid(condensed, n)
+    else:
+        raise ValueError(f"Unknown neighbor joining algorithm '{algorithm}'")
+
+
+def _neighbor_joining_scan(distances_vec, n):
+    nodes = np.array([TreeNode(index=i) for i in range(n)])
+    n_rem_nodes = n
+    starts = row_starts(n)
+    # Sum of the distances of each node to all remaining nodes,
+    # updated on each merge
+    divergence = _divergence(distances_vec, starts)
 
-    nodes = np.array([TreeNode(index=i) for i in range(distances.shape[0])])
-    is_clustered = np.full(distances.shape[0], False, dtype=np.uint8)
-    n_rem_nodes = len(distances) - np.count_nonzero(is_clustered)
-    divergence = np.zeros(distances.shape[0], dtype=np.float32)
-    corr_distances = np.zeros((distances.shape[0],) * 2, dtype=np.float32)
-    distances_mat = distances.astype(np.float32, copy=True)
+    # Distances of clustered nodes are set to infinity;
+    # 'active' holds the node index of each row of 'distances_vec'
+    active = np.arange(n)
+    is_clustered = np.full(n, False, dtype=bool)
 
     while True:
-        # Calculate divergence
-        for i in range(distances_mat.shape[0]):
-            if is_clustered[i]:
-                continue
-            dist_sum = 0
-            for k in range(distances_mat.shape[0]):
-                if is_clustered[k]:
-                    continue
-                dist_sum += distances_mat[i, k]
-            divergence[i] = dist_sum
-        
-        # Calculate corrected distance matrix
-        for i in range(distances_mat.shape[0]):
-            if is_clustered[i]:
-                continue
-            for j in range(i):
-                if is_clustered[j]:
-                    continue
-                corr_distances[i, j] = (n_rem_nodes - 2) * distances_mat[i, j] - divergence[i] - divergence[j]
-
-        # Find minimum corrected distance
-        dist_min = MAX_FLOAT
-        i_min = -1
-        j_min = -1
-        for i in range(corr_distances.shape[0]):
-            if is_clustered[i]:
-                continue
-            for j in range(i):
-                if is_clustered[j]:
-                    continue
-                dist = corr_distances[i, j]
-                if dist < dist_min:
-                    dist_min = dist
-                    i_min = i
-                    j_min = j
-        
-        if i_min == -1 or j_min == -1:
-            break
+        if n_rem_nodes <= len(active) // 2:
+            # Drop the rows and columns of clustered nodes,
+            # keeping the remaining ones in order
+            keep = np.flatnonzero(~is_clustered)
+            distances_vec, starts = condensed_submatrix(distances_vec, starts, keep)
+            active = active[keep]
+            is_clustered = is_clustered[keep]
+
+        i_row, j_row = _min_corrected_distance(
+            distances_vec, starts, divergence[active].astype(np.float32),
+            n_rem_nodes
+        )
+        i_min = active[i_row]
+        j_min = active[j_row]
+        row_i = condensed_row(distances_vec, starts, i_row)
+        row_j = condensed_row(distances_vec, starts, j_row)
+        dist_ij = row_i[j_row]
+        div_i = divergence[i_min]
+        div_j = divergence[j_min]
+
+        node_dist_i = 0.5 * (dist_ij + 1/(n_rem_nodes-2) * (div_i - div_j))
+        node_dist_j = 0.5 * (dist_ij + 1/(n_rem_nodes-2) * (div_j - div_i))
         
-        node_dist_i = 0.5 * (distances_mat[i_min, j_min] + 1/(n_rem_nodes-2) * (divergence[i_min] - divergence[j_min]))
-        node_dist_j = 0.5 * (distances_mat[i_min, j_min] + 1/(n_rem_nodes-2) * (divergence[j_min] - divergence[i_min]))
+        if n_rem_nodes > 3:
+            nodes[i_min] = TreeNode((nodes[i_min], nodes[j_min]), (node_dist_i, node_dist_j))
+            nodes[j_min] = None
+        else:
+            is_clustered[i_row] = True
+            is_clustered[j_row] = True
+            k_row = np.flatnonzero(~is_clustered)[0]
+            k = active[k_row]
+            node_dist_k = 0.5 * (row_i[k_row] + row_j[k_row] - dist_ij)
+            root = TreeNode((nodes[i_min], nodes[j_min], nodes[k]), (node_dist_i, node_dist_j, node_dist_k))
+            return Tree(root)
         
+        # Update distance matrix
+        # (infinity for the clustered nodes and 'i_min' itself)
+        dist = 0.5 * (row_i + row_j - dist_ij)
+        set_condensed_row(distances_vec, starts, i_row, dist)
+        set_condensed_row(
+            distances_vec, starts, j_row, np.full(len(starts), np.inf)
+        )
+        is_clustered[j_row] = True
+        n_rem_nodes -= 1
+
+        # Update divergence of the remaining nodes
+        others = ~is_clustered
+        others[i_row] = False
+        other_nodes = active[others]
+        divergence[other_nodes] += (
+            dist[others].astype(np.float64)
+            - row_i[others] - row_j[others]
+        )
+        divergence[i_min] = dist[others].sum(dtype=np.float64)
+
+
+def _divergence(distances_vec, starts):
+    """
+    Sum of the distances of each node to all other nodes.
+    """
+    return np.array([
+        condensed_row(distances_vec, starts, i, diagonal=0).sum(dtype=np.float64)
+        for i in range(len(starts))
+    ])
+
+
+def _min_corrected_distance(distances_vec, starts, divergence, n_rem_nodes):
+    """
+    Pair `(i, j)`, `i > j`, with minimum corrected distance; of tied
+    pairs the first one in a row-by-row scan of the lower triangle.
+
+    The corrected distances are computed for a few rows of the condensed
+    vector at a time, so that no matrix of them is held in memory.
+    """
+    n = len(starts)
+    factor = np.float32(n_rem_nodes - 2)
+    best = np.inf
+    best_rows = []
+    best_cols = []
+    first_rows = np.unique(np.searchsorted(
+        starts, np.arange(0, len(distances_vec), CHUNK_SIZE), side="right"
+    ) - 1)
+    for first_row, end_row in zip(first_rows, np.append(first_rows[1:], n - 1)):
+        rows = np.arange(first_row, end_row)
+        lengths = n - 1 - rows
+        offset = starts[first_row]
+        corr_distances = distances_vec[offset : offset + lengths.sum()] * factor
+        # The columns of row 'i' are 'i+1' to 'n-1'
+        corr_distances -= np.concatenate([divergence[i + 1:] for i in rows])
+        corr_distances -= np.repeat(divergence[first_row:end_row], lengths)
+        chunk_min = corr_distances.min()
+        if chunk_min > best:
+            continue
+        if chunk_min < best:
+            best = chunk_min
+            best_rows = []
+            best_cols = []
+        ties = offset + np.flatnonzero(corr_distances == chunk_min)
+        tie_rows = np.searchsorted(starts, ties, side="right") - 1
+        best_rows.append(tie_rows)
+        best_cols.append(ties - starts[tie_rows] + tie_rows + 1)
+    best_rows = np.concatenate(best_rows)
+    best_cols = np.concatenate(best_cols)
+    first = np.lexsort((best_rows, best_cols))[0]
+    return best_cols[first], best_rows[first]
+
+
+def _neighbor_joining_rapid(distances_vec, n):
+    nodes = np.array([TreeNode(index=i) for i in range(n)])
+    n_rem_nodes = n
+    starts = row_starts(n)
+    # Same divergence and arithmetic as the scan, so that ties and
+    # rounding resolve identically
+    divergence = _divergence(distances_vec, starts)
+    is_clustered = np.full(n, False, dtype=bool)
+
+    # Each row holds the distances to the other nodes in ascending order
+    # ('sorted_dist') and the nodes they belong to ('sorted_nodes');
+    # a joined node gets a new row and keeps the larger node index,
+    # so entries pointing to nodes created after their row are outdated
+    sorted_dist, sorted_nodes = _sort_rows(distances_vec, starts)
+    # Number of joins before the node of each row was created
+    created = np.zeros(n, dtype=np.int64)
+    n_joins = 0
+    n_sorted = n_rem_nodes
+
+    while True:
+        if n_rem_nodes <= n_sorted // 2:
+            # Drop outdated entries and shorten the rows
+            valid = _valid_entries(
+                sorted_nodes, np.arange(len(sorted_nodes)), is_clustered, created
+            )
+            sorted_dist = np.where(valid, sorted_dist, np.inf)
+            order = np.argsort(sorted_dist, axis=1, kind="stable")[:, :n_rem_nodes]
+            sorted_dist = np.take_along_axis(sorted_dist, order, axis=1)
+            sorted_nodes = np.take_along_axis(sorted_nodes, order, axis=1)
+            n_sorted = n_rem_nodes
+
+        i_min, j_min = _find_join(
+            sorted_dist, sorted_nodes, divergence, is_clustered, created,
+            n_rem_nodes
+        )
+        row_i = condensed_row(distances_vec, starts, i_min)
+        row_j = condensed_row(distances_vec, starts, j_min)
+        dist_ij = row_i[j_min]
+        div_i = divergence[i_min]
+        div_j = divergence[j_min]
+
+        node_dist_i = 0.5 * (dist_ij + 1/(n_rem_nodes-2) * (div_i - div_j))
+        node_dist_j = 0.5 * (dist_ij + 1/(n_rem_nodes-2) * (div_j - div_i))
+
         if n_rem_nodes > 3:
             nodes[i_min] = TreeNode((nodes[i_min], nodes[j_min]), (node_dist_i, node_dist_j))
             nodes[j_min] = None
-            is_clustered[j_min] = True
         else:
             is_clustered[i_min] = True
             is_clustered[j_min] = True
-            k = np.where(~is_clustered.astype(bool))[0][0]
-            node_dist_k = 0.5 * (distances_mat[i_min, k] + distances_mat[j_min, k] - distances_mat[i_min, j_min])
+            k = np.flatnonzero(~is_clustered)[0]
+            node_dist_k = 0.5 * (row_i[k] + row_j[k] - dist_ij)
             root = TreeNode((nodes[i_min], nodes[j_min], nodes[k]), (node_dist_i, node_dist_j, node_dist_k))
             return Tree(root)
-        
+
         # Update distance matrix
-        for k in range(distances_mat.shape[0]):
-            if not is_clustered[k] and k != i_min:
-                dist = 0.5 * (distances_mat[i_min, k] + distances_mat[j_min, k] - distances_mat[i_min, j_min])
-                distances_mat[i_min, k] = dist
-                distances_mat[k, i_min] = dist
+        # (infinity for the clustered nodes and 'i_min' itself)
+        dist = 0.5 * (row_i + row_j - dist_ij)
+        set_condensed_row(distances_vec, starts, i_min, dist)
+        set_condensed_row(distances_vec, starts, j_min, np.full(n, np.inf))
+        is_clustered[j_min] = True
+        n_rem_nodes -= 1
+
+        # Update divergence of the remaining nodes
+        others = ~is_clustered
+        others[i_min] = False
+        other_nodes = np.flatnonzero(others)
+        divergence[other_nodes] += (
+            dist[others].astype(np.float64)
+            - row_i[others] - row_j[others]
+        )
+        divergence[i_min] = dist[others].sum(dtype=np.float64)
+
+        # Sorted row of the joined node
+        n_joins += 1
+        created[i_min] = n_joins
+        order = np.argsort(dist[others], kind="stable")
+        sorted_dist[i_min, :len(order)] = dist[others][order]
+        sorted_dist[i_min, len(order):] = np.inf
+        sorted_nodes[i_min, :len(order)] = other_nodes[order]
+        sorted_dist[j_min] = np.inf
+
+
+def _sort_rows(distances_vec, starts, chunk_size=1024):
+    """
+    Distances of each row in ascending order, with their columns,
+    excluding the diagonal.
+    """
+    n = len(starts)
+    sorted_dist = np.empty((n, n), dtype=np.float32)
+    sorted_nodes = np.empty((n, n), dtype=np.int32)
+    # Sort a few rows at a time to limit the memory of 'argsort()'
+    for start in range(0, n, chunk_size):
+        dist = np.stack([
+            condensed_row(distances_vec, starts, i)
+            for i in range(start, min(start + chunk_size, n))
+        ])
+        order = np.argsort(dist, axis=1, kind="stable")
+        sorted_dist[start : start + len(dist)] = np.take_along_axis(dist, order, axis=1)
+        sorted_nodes[start : start + len(dist)] = order
+    return sorted_dist, sorted_nodes
+
+
+def _valid_entries(nodes, rows, is_clustered, created):
+    """
+    Whether each sorted entry points to a remaining node, which existed
+    when the row was sorted.
+    """
+    return ~is_clustered[nodes] & (created[nodes] <= created[rows][:, np.newaxis])
+
+
+def _find_join(sorted_dist, sorted_nodes, divergence, is_clustered, created,
+               n_rem_nodes, block_size=16):
+    """
+    Pair of nodes with minimum corrected distance, with the same
+    tie-breaking as the scan, as (larger node index, smaller node index).
 
-        n_rem_nodes = len(distances) - np.count_nonzero(is_clustered)
\ No newline at end of file
+    The corrected distance of an entry `d(i,j)` in row `i` is at least
+    ``(n-2) * d(i,j) - div(i) - max(div)``, so the remaining entries of a row
+    can be skipped once this bound exceeds the minimum found so far.
+    """
+    rows = np.flatnonzero(~is_clustered)
+    row_divergence = divergence.astype(np.float32)
+    max_divergence = divergence[rows].max()
+    factor = np.float32(n_rem_nodes - 2)
+    # Margin for the rounding of corrected distances in single precision
+    margin = 1e-5
+    best = (np.inf, -1, -1)
+    col = 0
+    # The nearest neighbor of each row gives a first minimum
+    width = 1
+    while len(rows) > 0 and col < sorted_dist.shape[1]:
+        dist = sorted_dist[rows, col : col + width]
+        nodes = sorted_nodes[rows, col : col + width]
+        limit = (
+            (best[0] + (divergence[rows] + max_divergence) * (1 + margin))
+            / ((n_rem_nodes - 2) * (1 - margin))
+        )[:, np.newaxis]
+        candidates = (dist <= limit) & _valid_entries(nodes, rows, is_clustered, created)
+        if candidates.any():
+            row_index, entry = np.nonzero(candidates)
+            i = rows[row_index]
+            j = nodes[row_index, entry]
+            larger = np.maximum(i, j)
+            smaller = np.minimum(i, j)
+            corr_dist = (
+                dist[row_index, entry] * factor
+                - row_divergence[larger] - row_divergence[smaller]
+            )
+            ties = np.flatnonzero(corr_dist == corr_dist.min())
+            first = ties[np.lexsort((smaller[ties], larger[ties]))[0]]
+            candidate = (corr_dist[first], larger[first], smaller[first])
+            if candidate < best:
+                best = candidate
+        # Rows continue while their next entry may still beat the minimum
+        col += width
+        width = block_size
+        if col < sorted_dist.shape[1]:
+            limit = (
+                (best[0] + (divergence[rows] + max_divergence) * (1 + margin))
+                / ((n_rem_nodes - 2) * (1 - margin))
+            )
+            rows = rows[sorted_dist[rows, col] <= limit]
+    return int(best[1]), int(best[2])
@@ -19,9 +19,9 @@ def distances():
     return np.loadtxt(join(join(dirname(dirname(abspath(__file__))), "data"), "distances.txt"), dtype=int)
 
 
-@pytest.fixture
-def tree(distances):
-    return upgma(distances)
+@pytest.fixture(params=["scan", "nn_chain"])
+def tree(distances, request):
+    return upgma(distances, request.param)
 
 
 @pytest.fixture
@@ -51,6 +51,71 @@ def test_upgma(tree, upgma_newick):
             )
 
 
+def test_upgma_algorithms():
+    """
+    The nearest-neighbor chain gives the same tree as the full scan.
+    """
+    points = np.random.default_rng(0).random((60, 5))
+    dist = np.sqrt(((points[:, np.newaxis] - points[np.newaxis]) ** 2).sum(axis=-1))
+    scan_tree = upgma(dist, "scan")
+    chain_tree = upgma(dist, "nn_chain")
+    for i in range(len(scan_tree)):
+        for j in range(len(scan_tree)):
+            assert chain_tree.get_distance(i, j) == pytest.approx(
+                scan_tree.get_distance(i, j), abs=1e-5
+            )
+            assert chain_tree.get_distance(i, j, topological=True) \
+                == scan_tree.get_distance(i, j, topological=True)
+    with pytest.raises(ValueError):
+        upgma(dist, "unknown")
+
+
+def _upgma_row_scan(distances):
+    # Reference UPGMA on the square matrix: the closest pair (i > j) is
+    # the first one in a row-by-row scan of the lower triangle
+    n = len(distances)
+    nodes = [TreeNode(index=i) for i in range(n)]
+    is_clustered = np.full(n, False)
+    cluster_size = np.ones(n, dtype=np.uint32)
+    node_heights = np.zeros(n, dtype=np.float32)
+    distances = distances.astype(np.float32)
+    for _ in range(n - 1):
+        dist_min, i_min, j_min = np.inf, -1, -1
+        for i in range(n):
+            for j in range(i):
+                if not is_clustered[i] and not is_clustered[j] \
+                    and distances[i, j] < dist_min:
+                        dist_min, i_min, j_min = distances[i, j], i, j
+        height = dist_min / 2
+        nodes[i_min] = TreeNode(
+            (nodes[i_min], nodes[j_min]),
+            (height - node_heights[i_min], height - node_heights[j_min])
+        )
+        node_heights[i_min] = height
+        is_clustered[j_min] = True
+        for k in np.flatnonzero(~is_clustered):
+            if k != i_min:
+                distances[i_min, k] = distances[k, i_min] = (
+                    distances[i_min, k] * cluster_size[i_min]
+                    + distances[j_min, k] * cluster_size[j_min]
+                ) / (cluster_size[i_min] + cluster_size[j_min])
+        cluster_size[i_min] += cluster_size[j_min]
+    return Tree(nodes[n - 1])
+
+
+def test_upgma_ties():
+    """
+    On tied distances the full scan merges the first closest pair of a
+    row-by-row scan of the lower triangle, like the square matrix
+    implementation did.
+    """
+    rng = np.random.default_rng(0)
+    for _ in range(30):
+        dist = rng.integers(1, 4, (20, 20))
+        dist = np.triu(dist, 1) + np.triu(dist, 1).T
+        assert upgma(dist, "scan") == _upgma_row_scan(dist)
+
+
 def test_neighbor_joining():
     """
     Compare the results of `neighbor_join()` with a known tree.
@@ -98,6 +163,64 @@ def test_neighbor_joining():
     assert test_tree == ref_tree
 
 
+@pytest.mark.parametrize("integer", [False, True])
+def test_neighbor_joining_algorithms(integer):
+    """
+    The bounded search of RapidNJ gives exactly the tree of the full scan,
+    also when corrected distances are tied.
+    """
+    rng = np.random.default_rng(0)
+    if integer:
+        dist = rng.integers(1, 10, (80, 80))
+    else:
+        points = rng.random((80, 5))
+        dist = np.sqrt(((points[:, np.newaxis] - points[np.newaxis]) ** 2).sum(axis=-1))
+    dist = np.triu(dist, 1)
+    dist = dist + dist.T
+    assert neighbor_joining(dist, "rapid") == neighbor_joining(dist, "scan")
+    with pytest.raises(ValueError):
+        neighbor_joining(dist, "unknown")
+
+
+def test_neighbor_joining_additive(tree):
+    """
+    `neighbor_joining()` recovers a tree from its own leaf distances.
+    """
+    dist = np.array([
+        [tree.get_distance(i, j) for j in range(len(tree))]
+        for i in range(len(tree))
+    ])
+    test_tree = neighbor_joining(dist)
+    for i in range(len(tree)):
+        for j in range(len(tree)):
+            assert test_tree.get_distance(i, j) == pytest.approx(dist[i, j], abs=1e-3)
+
+
+@pytest.mark.parametrize("algorithm", ["scan", "nn_chain"])
+def test_upgma_condensed(distances, algorithm):
+    """
+    A condensed distance vector in `pdist()` layout gives the same tree
+    as the square matrix.
+    """
+    condensed = distances[np.triu_indices(len(distances), k=1)]
+    assert upgma(condensed, algorithm) == upgma(distances, algorithm)
+    with pytest.raises(ValueError):
+        upgma(condensed[:-1], algorithm)
+
+
+@pytest.mark.parametrize("algorithm", ["scan", "rapid"])
+def test_neighbor_joining_condensed(distances, algorithm):
+    """
+    A condensed distance vector in `pdist()` layout gives the same tree
+    as the square matrix.
+    """
+    condensed = distances[np.triu_indices(len(distances), k=1)]
+    assert neighbor_joining(condensed, algorithm) \
+        == neighbor_joining(distances, algorithm)
+    with pytest.raises(ValueError):
+        neighbor_joining(condensed[:-1], algorithm)
+
+
 def test_distances(tree):
     # Tree is created via UPGMA
     # -> The distances to root should be equal for all leaf nodes
@@ -7,52 +7,85 @@ __all__ = ["upgma"]
 
 import numpy as np
 from tree import Tree, TreeNode
+from distances import (
+    condensed_distances, row_starts, condensed_row, set_condensed_row,
+    condensed_submatrix
+)
 
 
 MAX_FLOAT = np.finfo(np.float32).max
 
 
-def upgma(distances):
+def upgma(distances, algorithm="scan"):
+    """
+    Build an ultrametric tree by UPGMA clustering.
+
+    `distances` is either a symmetric matrix or a condensed vector of
+    its upper triangle, as returned by
+    :func:`scipy.spatial.distance.pdist()`; the clustering works on
+    such a condensed single precision copy in either case.
+    `algorithm` selects how the closest clusters are found:
+    ``"scan"`` searches the whole remaining matrix on every merge
+    (*O(n³)*), ``"nn_chain"`` follows chains of nearest neighbors
+    (*O(n²)*) and suits large matrices.
+    Both give the same tree, unless distances are tied.
+    """
     distances = np.asarray(distances)
     
-    if distances.shape[0] != distances.shape[1] \
-        or not np.allclose(distances.T, distances):
-            raise ValueError("Distance matrix must be symmetric")
     if np.isnan(distances).any():
         raise ValueError("Distance matrix contains NaN values")
     if (distances >= MAX_FLOAT).any():
         raise ValueError("Distance matrix contains infinity")
     if (distances < 0).any():
         raise ValueError("Distances must be positive")
+    condensed, n = condensed_distances(distances)
 
-    nodes = np.array(
-        [TreeNode(index=i) for i in range(distances.shape[0])]
-    )
-    is_clustered = np.full(distances.shape[0], False, dtype=np.uint8)
-    cluster_size = np.ones(distances.shape[0], dtype=np.uint32)
-    node_heights = np.zeros(distances.shape[0], dtype=np.float32)
+    if algorithm == "scan":
+        return _upgma_scan(condensed, n)
+    elif algorithm == "nn_chain":
+        return _upgma_nn_chain(condensed, n)
+    else:
+        raise ValueError(f"Unknown UPGMA algorithm '{algorithm}'")
 
-    distances_mat = distances.astype(np.float32, copy=True)
-    
-    while True:
-        # Find minimum distance
-        dist_min = MAX_FLOAT
-        i_min = -1
-        j_min = -1
-        for i in range(distances_mat.shape[0]):
-            if is_clustered[i]:
-                continue
-            for j in range(i):
-                if is_clustered[j]:
-                    continue
-                dist = distances_mat[i, j]
-                if dist < dist_min:
-                    dist_min = dist
-                    i_min = i
-                    j_min = j
-        
-        if i_min == -1 or j_min == -1:
-            break
+
+def _upgma_scan(distances_vec, n):
+    nodes = np.array([TreeNode(index=i) for i in range(n)])
+    cluster_size = np.ones(n, dtype=np.uint32)
+    node_heights = np.zeros(n, dtype=np.float32)
+
+    # Distances of clustered nodes are set to infinity
+    starts = row_starts(n)
+    # Node index of each row (and column) of 'distances_vec'
+    active = np.arange(n)
+    is_clustered = np.full(n, False, dtype=bool)
+    n_active = n
+
+    while n_active > 1:
+        if n_active <= len(active) // 2:
+            # Drop the rows and columns of clustered nodes,
+            # keeping the remaining ones in order
+            keep = np.flatnonzero(~is_clustered)
+            distances_vec, starts = condensed_submatrix(distances_vec, starts, keep)
+            active = active[keep]
+            is_clustered = is_clustered[keep]
+
+        # Find minimum distance; of tied pairs (i > j) take the first
+        # one in a row-by-row scan of the lower triangle.
+        # 'argmin()' returns the first pair (j, i) in the upper triangle,
+        # tied pairs with a smaller 'i' can only lie before row 'i - 1'
+        pos = int(np.argmin(distances_vec))
+        dist_min = distances_vec[pos]
+        j_row = np.searchsorted(starts, pos, side="right") - 1
+        i_row = pos - starts[j_row] + j_row + 1
+        pos = np.concatenate(([pos], pos + 1 + np.flatnonzero(
+            distances_vec[pos + 1 : starts[i_row - 1]] == dist_min
+        )))
+        rows = np.searchsorted(starts, pos, side="right") - 1
+        cols = pos - starts[rows] + rows + 1
+        first = np.lexsort((rows, cols))[0]
+        i_row, j_row = cols[first], rows[first]
+        i_min = active[i_row]
+        j_min = active[j_row]
         
         height = dist_min / 2
         nodes[i_min] = TreeNode(
@@ -61,20 +94,77 @@ def upgma(distances):
         )
         node_heights[i_min] = height
         nodes[j_min] = None
-        is_clustered[j_min] = True
         
         # Calculate arithmetic mean distances
-        for k in range(distances_mat.shape[0]):
-            if not is_clustered[k] and k != i_min:
-                mean = (
-                    (
-                        distances_mat[i_min, k] * cluster_size[i_min]
-                        + distances_mat[j_min, k] * cluster_size[j_min]
-                    ) / (cluster_size[i_min] + cluster_size[j_min])
-                )
-                distances_mat[i_min, k] = mean
-                distances_mat[k, i_min] = mean
+        # (infinity for the clustered nodes and 'i_min' itself)
+        mean = (
+            condensed_row(distances_vec, starts, i_row).astype(np.float64)
+            * cluster_size[i_min]
+            + condensed_row(distances_vec, starts, j_row).astype(np.float64)
+            * cluster_size[j_min]
+        ) / (cluster_size[i_min] + cluster_size[j_min])
+        set_condensed_row(distances_vec, starts, i_row, mean)
+        set_condensed_row(
+            distances_vec, starts, j_row, np.full(len(starts), np.inf)
+        )
+        is_clustered[j_row] = True
+        n_active -= 1
         
         cluster_size[i_min] = cluster_size[i_min] + cluster_size[j_min]
 
-    return Tree(nodes[len(nodes) - 1])
\ No newline at end of file
+    return Tree(nodes[len(nodes) - 1])
+
+
+def _upgma_nn_chain(distances_vec, n):
+    nodes = np.array([TreeNode(index=i) for i in range(n)])
+    is_clustered = np.full(n, False, dtype=bool)
+    cluster_size = np.ones(n, dtype=np.uint32)
+    node_heights = np.zeros(n, dtype=np.float32)
+
+    # Distances of clustered nodes are set to infinity
+    starts = row_starts(n)
+    n_active = n
+
+    # Each node in the chain is the nearest neighbor of its predecessor;
+    # the last two nodes are merged, when they are reciprocal nearest
+    # neighbors, which UPGMA would merge at some point anyway
+    chain = []
+    while n_active > 1:
+        if len(chain) == 0:
+            chain.append(int(np.argmin(is_clustered)))
+        i = chain[-1]
+        row = condensed_row(distances_vec, starts, i)
+        j = int(np.argmin(row))
+        # On ties prefer the predecessor, so that the chain ends
+        if len(chain) > 1 and row[chain[-2]] <= row[j]:
+            j = chain[-2]
+        if len(chain) == 1 or j != chain[-2]:
+            chain.append(j)
+            continue
+        del chain[-2:]
+
+        # Like the scan, keep the merged cluster at the larger index
+        i_min, j_min = max(i, j), min(i, j)
+        height = row[j] / 2
+        nodes[i_min] = TreeNode(
+            (nodes[i_min], nodes[j_min]),
+            (height - node_heights[i_min], height - node_heights[j_min])
+        )
+        node_heights[i_min] = height
+        nodes[j_min] = None
+
+        # Calculate arithmetic mean distances
+        mean = (
+            condensed_row(distances_vec, starts, i_min).astype(np.float64)
+            * cluster_size[i_min]
+            + condensed_row(distances_vec, starts, j_min).astype(np.float64)
+            * cluster_size[j_min]
+        ) / (cluster_size[i_min] + cluster_size[j_min])
+        set_condensed_row(distances_vec, starts, i_min, mean)
+        set_condensed_row(distances_vec, starts, j_min, np.full(n, np.inf))
+        is_clustered[j_min] = True
+        n_active -= 1
+
+        cluster_size[i_min] = cluster_size[i_min] + cluster_size[j_min]
+
+    return Tree(nodes[len(nodes) - 1])